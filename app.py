@@ -1,25 +1,40 @@
 # -*- coding: utf-8 -*-
 
+import bisect
 import cachetools
+import click
 import collections
+import concurrent.futures
+import contextvars
 import decorator
 import flask
+import functools
 import iiif_prezi.factory
 import json
 from markupsafe import Markup
 import mwapi
 import mwoauth
+import os
 import random
 import re
 import requests
+import requests.adapters
 import requests_oauthlib
 import string
 import threading
+import time
 import toolforge
 import urllib.parse
 import yaml
 
+import caches
+import dumps
+import metrics
+import region_index
+import sparql
+import tracing
 from exceptions import WrongDataValueType
+from regions import Region, RegionIndex, depicted_regions, normalize, parse_point, regions_to_pixels
 from toolforge_i18n import ToolforgeI18n, interface_language_code_from_request, lang_autonym, message, pop_html_lang, push_html_lang
 import messages
 
@@ -47,6 +62,26 @@ requests_session.headers.update({
 
 default_property = 'P18'
 
+# number of items per page on /iiif_region/
+iiif_region_page_size = 50
+
+# annotation lists with more depicteds than this are streamed
+annotations_streaming_threshold = 100
+
+# number of manifests per page of an IIIF collection
+collection_page_size = 50
+
+# maximum number of items in an IIIF collection of items with a region
+collection_max_items = 10_000
+
+# maximum number of qualifiers in one /api/v3/add_qualifiers/ request;
+# clients with more qualifiers send several requests
+max_qualifiers_per_request = 50
+
+# seconds after which /api/v3/add_qualifiers/ starts no more edits,
+# so that the response is sent well before gunicorn’s worker timeout (30 seconds by default)
+add_qualifiers_time_limit = 20
+
 # maps property IDs to message keys for “… with no region specified:” list labels
 # note: currently, these must be item-type properties;
 # support for other data types (e.g. P1684 inscription) would need more work
@@ -62,6 +97,27 @@ app.add_template_global(
 
 app.config.from_file('config.yaml', load=toolforge.load_private_yaml, silent=True)
 app.config.from_prefixed_env('TOOL', loads=yaml.safe_load)
+
+# thread pool for upstream requests that can be sent in parallel
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=app.config.get('MAX_WORKERS', 8))
+
+# separate small thread pool for edits, so that batches of edits neither hold up page loads
+# nor send more than a few edits at once (which could run into the edit rate limits)
+edit_executor = concurrent.futures.ThreadPoolExecutor(max_workers=app.config.get('EDIT_WORKERS', 2))
+
+def run_concurrently(*functions, pool=None):
+    """Call the given functions concurrently and return their results, in order.
+
+    The functions run with the current context (flask.g, flask.request etc.).
+    The first function runs in the current thread, the others in the pool (default: the executor);
+    only the first function may itself wait for further executor tasks,
+    otherwise nested tasks could starve the executor.
+    """
+    if not functions:
+        return []
+    futures = [(pool or executor).submit(contextvars.copy_context().run, function)
+               for function in functions[1:]]
+    return [functions[0](), *(future.result() for future in futures)]
 if 'OAUTH' in app.config:
     consumer_token = mwoauth.ConsumerToken(app.config['OAUTH']['CONSUMER_KEY'], app.config['OAUTH']['CONSUMER_SECRET'])
     assert app.secret_key is not None, 'If OAuth is configured, the SECRET_KEY must also be configured (a fixed random string)'
@@ -70,18 +126,91 @@ else:
     if app.secret_key is None:
         app.secret_key = 'fake'
 
+# sessions are reused across requests (per worker process),
+# so that connections to the APIs are kept alive instead of handshaking again every time
+_anonymous_sessions = {}
+_authenticated_sessions = cachetools.LRUCache(maxsize=app.config.get('AUTHENTICATED_SESSIONS_MAXSIZE', 100))
+_sessions_lock = threading.Lock()
+
+def pooled_requests_session():
+    """Create a requests.Session whose connection pool suits our executor."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=app.config.get('HTTP_POOL_SIZE', 10))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 def anonymous_session(domain):
-    host = 'https://' + domain
-    return mwapi.Session(host=host, user_agent=user_agent, formatversion=2)
+    with _sessions_lock:
+        session = _anonymous_sessions.get(domain)
+        if session is None:
+            host = 'https://' + domain
+            session = tracing.TracedSession(host=host, user_agent=user_agent, formatversion=2,
+                                            session=pooled_requests_session())
+            _anonymous_sessions[domain] = session
+        return session
 
 def authenticated_session(domain):
     if 'oauth_access_token' not in flask.session:
         return None
-    host = 'https://' + domain
     access_token = mwoauth.AccessToken(**flask.session['oauth_access_token'])
-    auth = requests_oauthlib.OAuth1(client_key=consumer_token.key, client_secret=consumer_token.secret,
-                                    resource_owner_key=access_token.key, resource_owner_secret=access_token.secret)
-    return mwapi.Session(host=host, auth=auth, user_agent=user_agent, formatversion=2)
+    key = (domain, access_token.key)
+    with _sessions_lock:
+        session = _authenticated_sessions.get(key)
+        if session is None:
+            host = 'https://' + domain
+            auth = requests_oauthlib.OAuth1(client_key=consumer_token.key, client_secret=consumer_token.secret,
+                                            resource_owner_key=access_token.key, resource_owner_secret=access_token.secret)
+            session = tracing.TracedSession(host=host, auth=auth, user_agent=user_agent, formatversion=2,
+                                            session=pooled_requests_session())
+            _authenticated_sessions[key] = session
+        return session
+
+# CSRF tokens of the wikis, keyed by (domain, OAuth access token key);
+# MediaWiki tokens are tied to the user session, which lasts as long as the OAuth grant
+_csrf_tokens = cachetools.TTLCache(maxsize=app.config.get('AUTHENTICATED_SESSIONS_MAXSIZE', 100) * 2,
+                                   ttl=60 * 60)
+_csrf_tokens_lock = threading.Lock()
+
+def wiki_csrf_token(session, domain, fresh=False):
+    """Get the user’s CSRF token for the domain, cached unless fresh is set."""
+    key = (domain, flask.session['oauth_access_token']['key'])
+    if not fresh:
+        with _csrf_tokens_lock:
+            token = _csrf_tokens.get(key)
+        if token is not None:
+            return token
+    token = session.get(action='query', meta='tokens', type='csrf')['query']['tokens']['csrftoken']
+    with _csrf_tokens_lock:
+        _csrf_tokens[key] = token
+    return token
+
+def post_with_csrf_token(session, domain, **params):
+    """POST to the API with the user’s CSRF token for the domain.
+
+    The token is cached, saving a round trip for most edits;
+    if the token has become invalid, get a fresh one and retry once."""
+    try:
+        return session.post(**params, token=wiki_csrf_token(session, domain))
+    except mwapi.errors.APIError as error:
+        if error.code != 'badtoken':
+            raise
+    return session.post(**params, token=wiki_csrf_token(session, domain, fresh=True))
+
+def http_connection_info():
+    """Get the number of HTTP requests and new connections (handshakes)
+    made by the pooled sessions of this process."""
+    with _sessions_lock:
+        sessions = [*_anonymous_sessions.values(), *_authenticated_sessions.values()]
+    info = {'requests': 0, 'connections': 0}
+    for session in sessions:
+        pools = session.session.get_adapter('https://').poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is not None:
+                info['requests'] += pool.num_requests
+                info['connections'] += pool.num_connections
+    return info
 
 
 @decorator.decorator
@@ -121,6 +250,8 @@ def index():
         if 'image_title' in flask.request.form:
             image_title = parse_image_title_input(flask.request.form['image_title'])
             return flask.redirect(flask.url_for('file', image_title=image_title))
+        if 'queue_source' in flask.request.form:
+            return create_queue(flask.request.form['queue_source'], flask.request.form.get('queue_input', ''))
     return flask.render_template('index.html',
                                  labels=load_labels(['P2677', 'P180', 'P9664', 'P18']))
 
@@ -264,14 +395,39 @@ def item_and_property(item_id, property_id):
 def iiif_manifest(item_id):
     return flask.redirect(flask.url_for('iiif_manifest_with_property', item_id=item_id, property_id=default_property))
 
+# rendered manifests (as JSON strings), keyed by item, property, language, revisions and URL
+_manifests_cache = caches.make_cache(app.config.get('CACHE', {}), 'manifests',
+                                     maxsize=app.config.get('MANIFESTS_CACHE_MAXSIZE', 1000),
+                                     ttl=app.config.get('MANIFESTS_CACHE_TTL', 24 * 60 * 60))
+
 @app.route('/iiif/<item_id>/<property_id>/manifest.json')
 @enableCORS
 def iiif_manifest_with_property(item_id, property_id):
-    item = load_item_and_property(item_id, property_id, include_description=True, include_metadata=True)
-    if 'image_title' not in item:
+    revisions = load_revisions(item_id, property_id, include_description=True)
+    if revisions is None:
         return '', 404
-    manifest = build_manifest(item)
-    return flask.jsonify(manifest.toJSON(top=True))
+    item_revision_id, image_revision_id = revisions
+    etag = revisions_etag(item_revision_id, image_revision_id)
+    if flask.request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    # the manifest only needs to be rebuilt if the item or the file were edited
+    # (labels of other entities may be outdated until the cache entry expires)
+    cache_key = ':'.join([
+        item_id,
+        property_id,
+        flask.g.interface_language_code,
+        str(item_revision_id),
+        str(image_revision_id),
+        current_url(),
+    ])
+    manifest_json = _manifests_cache.get(cache_key)
+    if manifest_json is None:
+        item = load_item_and_property(item_id, property_id, include_description=True, include_metadata=True)
+        manifest = build_manifest(item)
+        manifest_json = json.dumps(manifest.toJSON(top=True), separators=(',', ':'))
+        _manifests_cache.set(cache_key, manifest_json)
+    return add_cache_validators(flask.Response(manifest_json, mimetype='application/json'), etag)
 
 @app.route('/iiif/<item_id>/list/annotations.json')
 def iiif_annotations(item_id):
@@ -280,7 +436,13 @@ def iiif_annotations(item_id):
 @app.route('/iiif/<item_id>/<property_id>/list/annotations.json')
 @enableCORS
 def iiif_annotations_with_property(item_id, property_id):
-    item = load_item_and_property(item_id, property_id, include_depicteds=True)
+    revisions = load_revisions(item_id, property_id)
+    if revisions is not None:
+        etag = revisions_etag(*revisions)
+        if flask.request.if_none_match.contains(etag):
+            return not_modified(etag)
+    # depicted labels are loaded in chunks while the annotations are generated
+    item = load_item_and_property(item_id, property_id, include_depicteds=True, include_depicted_labels=False)
 
     url = flask.url_for('iiif_annotations_with_property',
                         item_id=item_id,
@@ -295,41 +457,61 @@ def iiif_annotations_with_property(item_id, property_id):
     }
 
     if 'image_title' not in item:
-        return flask.jsonify(annolist)
+        return flask.jsonify(annolist)  # no ETag: there is no image revision
 
     canvas_url = url[:-len('list/annotations.json')] + 'canvas/c0.json'
     # Although the pct canvas is OK for the image API, we need to target
     # canvas coordinates with the annotations, so we need the w,h
-    image_info = load_image_info(item['image_title'])
-    width, height = int(image_info['thumbwidth']), int(image_info['thumbheight'])
-
-    for depicted in item['depicteds']:
-        if 'item_id' not in depicted:
-            continue  # somevalue/novalue not supported for now
-        link = 'http://www.wikidata.org/entity/' + Markup.escape(depicted['item_id'])
-        label = depicted['label']['value']
-        # We can put a lot more in here, but minimum for now, and ensure works in Mirador
-        anno = {
-            '@id': '#' + depicted['statement_id'],
-            '@type': 'oa:Annotation',
-            'motivation': 'identifying',
-            'on': canvas_url,
-            'resource': {
-                '@id': link,
-                'format': 'text/plain',
-                'chars': label
+    width, height = canvas_size(item)
+
+    depicteds = [depicted for depicted in item['depicteds']
+                 if 'item_id' in depicted]  # somevalue/novalue not supported for now
+    regions = regions_to_pixels(depicted_regions(depicteds, skip_invalid=True),
+                                (item['image_width'], item['image_height']),
+                                (width, height))
+    chunks = annotation_list_chunks(annolist, depicteds, canvas_url, regions)
+    if len(depicteds) > annotations_streaming_threshold:
+        # stream large lists, so the first annotations are sent
+        # before the labels of the later ones have been loaded
+        response = flask.Response(flask.stream_with_context(chunks), mimetype='application/json')
+    else:
+        response = flask.Response(''.join(chunks), mimetype='application/json')
+    return add_cache_validators(response, etag)
+
+def annotation_list_chunks(annolist, depicteds, canvas_url, regions):
+    """Generate the JSON of an annotation list in chunks.
+
+    annolist is the annotation list without resources;
+    regions are the pixel regions of the depicteds on the canvas (or None);
+    the labels of the depicteds are loaded 50 at a time."""
+    annolist = {key: value for key, value in annolist.items() if key != 'resources'}
+    yield json.dumps(annolist, separators=(',', ':'))[:-1] + ',"resources":['
+
+    for chunk_start in range(0, len(depicteds), 50):
+        chunk = depicteds[chunk_start:chunk_start + 50]
+        labels = load_labels([depicted['item_id'] for depicted in chunk])
+        annos = []
+        for depicted, region in zip(chunk, regions[chunk_start:chunk_start + 50]):
+            link = 'http://www.wikidata.org/entity/' + Markup.escape(depicted['item_id'])
+            label = labels[depicted['item_id']]['value']
+            # We can put a lot more in here, but minimum for now, and ensure works in Mirador
+            anno = {
+                '@id': '#' + depicted['statement_id'],
+                '@type': 'oa:Annotation',
+                'motivation': 'identifying',
+                'on': canvas_url,
+                'resource': {
+                    '@id': link,
+                    'format': 'text/plain',
+                    'chars': label
+                }
             }
-        }
-        iiif_region = depicted.get('iiif_region', None)
-        if iiif_region:
-            parts = iiif_region.replace('pct:', '').split(',')
-            x = int(float(parts[0]) * width / 100)
-            y = int(float(parts[1]) * height / 100)
-            w = int(float(parts[2]) * width / 100)
-            h = int(float(parts[3]) * height / 100)
-            anno['on'] = anno['on'] + '#xywh=' + ','.join(str(d) for d in [x, y, w, h])
-        annolist['resources'].append(anno)
-    return flask.jsonify(annolist)
+            if region:
+                anno['on'] = anno['on'] + '#xywh=' + ','.join(str(d) for d in [region.x, region.y, region.w, region.h])
+            annos.append(json.dumps(anno, separators=(',', ':')))
+        yield (',' if chunk_start else '') + ','.join(annos)
+
+    yield ']}'
 
 @app.route('/iiif_region/<iiif_region>')
 def iiif_region(iiif_region):
@@ -337,6 +519,53 @@ def iiif_region(iiif_region):
 
 @app.route('/iiif_region/<iiif_region>/<property_id>')
 def iiif_region_and_property(iiif_region, property_id):
+    # only render one page of items at a time, there may be hundreds of them
+    page = flask.request.args.get('page', 1, type=int)
+    if page < 1:
+        flask.abort(400)
+    # one more item than needed, to know whether there is a next page
+    item_ids, partial = items_with_iiif_region(iiif_region,
+                                               limit=iiif_region_page_size + 1,
+                                               offset=(page - 1) * iiif_region_page_size)
+    has_next_page = len(item_ids) > iiif_region_page_size
+    item_ids = item_ids[:iiif_region_page_size]
+
+    items = []
+    items_without_image = []
+    for item in load_items_and_property(item_ids, property_id, include_depicteds=True):
+        if 'image_title' not in item:
+            items_without_image.append(item['entity_id'])
+        else:
+            items.append(item)
+
+    return flask.render_template('iiif_region.html',
+                                 items=items,
+                                 items_without_image=items_without_image,
+                                 partial=partial,
+                                 previous_page=page - 1 if page > 1 else None,
+                                 next_page=page + 1 if has_next_page else None)
+
+# SPARQL query results, keyed by the normalized query text
+_sparql_cache = caches.make_cache(app.config.get('CACHE', {}), 'sparql',
+                                  maxsize=app.config.get('SPARQL_CACHE_MAXSIZE', 1000),
+                                  ttl=app.config.get('SPARQL_CACHE_TTL', 5 * 60))
+query_service = sparql.SparqlEndpoint('https://query.wikidata.org/sparql', requests_session, _sparql_cache,
+                                      timeout=app.config.get('SPARQL_TIMEOUT', 30))
+
+# local index of depicted statements with regions, if configured (see region_index.py)
+region_store = region_index.RegionStore(app.config['REGION_INDEX'], readonly=True) if 'REGION_INDEX' in app.config else None
+
+def items_with_iiif_region(iiif_region, limit, offset=0):
+    """Get the IDs of items with depicted statements using the given region, ordered by ID.
+
+    The local region index is used if it is available,
+    unless it has no items with the region at all (they may have been added since the last update);
+    otherwise, the query service is asked.
+    Returns the item IDs and whether they are partial (because the query timed out)."""
+    if region_store is not None:
+        item_ids = region_store.entities_with_region(iiif_region, 'Q', limit=limit, offset=offset)
+        if item_ids or (item_ids is not None and offset):
+            return item_ids, False
     iiif_region_string = '"' + iiif_region.replace('\\', '\\\\').replace('"', '\\"') + '"'
     property_claim_predicates = ' '.join(f'p:{property_id}' for property_id in depicted_properties)
     query = '''
@@ -344,21 +573,98 @@ def iiif_region_and_property(iiif_region, property_id):
         VALUES ?p { %s }
         ?item ?p [ pq:P2677 %s ].
       }
+      ORDER BY ?item
     ''' % (property_claim_predicates, iiif_region_string)
-    query_results = requests_session.get('https://query.wikidata.org/sparql',
-                                         params={'query': query}).json()
+    result = query_service.select(query, limit=limit, offset=offset)
+    item_ids = [row['item'][len('http://www.wikidata.org/entity/'):] for row in result.rows]
+    return item_ids, result.partial
 
-    items = []
-    items_without_image = []
-    for result in query_results['results']['bindings']:
-        item_id = result['item']['value'][len('http://www.wikidata.org/entity/'):]
-        item = load_item_and_property(item_id, property_id, include_depicteds=True)
-        if 'image_title' not in item:
-            items_without_image.append(item_id)
-        else:
-            items.append(item)
+def plain_message(message_code, **kwargs):
+    """Format an interface message as plain text, e.g. for IIIF labels.
+
+    message() returns HTML, possibly wrapped in a <span lang> for a fallback language."""
+    return message(message_code, **kwargs).striptags()
+
+@app.route('/iiif/collection/<property_id>/collection.json')
+@enableCORS
+def iiif_collection(property_id):
+    item_ids = [parse_item_id_input(item_id)
+                for item_id in flask.request.args.get('items', '').split(',')
+                if item_id]
+    return build_collection(item_ids, property_id,
+                            label=plain_message('iiif-collection-label-items', num=len(item_ids)))
+
+@app.route('/iiif/collection/region/<iiif_region>/<property_id>/collection.json')
+@enableCORS
+def iiif_collection_region(iiif_region, property_id):
+    item_ids, _ = items_with_iiif_region(iiif_region, limit=collection_max_items)  # a partial collection is better than none
+    return build_collection(item_ids, property_id,
+                            label=plain_message('iiif-collection-label-region', region=iiif_region))
+
+def build_collection(item_ids, property_id, label):
+    """Build a paginated IIIF collection of the manifests of the given items.
+
+    Without a ?page= parameter, this is the top-level collection,
+    which only links to the first page; each page references up to
+    collection_page_size manifests, with labels and thumbnails,
+    loaded in one batch."""
+    url = current_url()
+    if flask.request.args.get('items'):
+        url += '?' + urllib.parse.urlencode({'items': flask.request.args['items']})
+
+    def page_url(page):
+        return url + ('&' if '?' in url else '?') + 'page=' + str(page)
+
+    page = flask.request.args.get('page', type=int)
+    if page is None:
+        collection = {
+            '@context': 'http://iiif.io/api/presentation/2/context.json',
+            '@id': url,
+            '@type': 'sc:Collection',
+            'label': label,
+            'total': len(item_ids),
+        }
+        if item_ids:
+            collection['first'] = page_url(1)
+        return flask.jsonify(collection)
+    if page < 1:
+        flask.abort(400)
+
+    offset = (page - 1) * collection_page_size
+    page_item_ids = item_ids[offset:offset + collection_page_size]
+    collection = {
+        '@context': 'http://iiif.io/api/presentation/2/context.json',
+        '@id': page_url(page),
+        '@type': 'sc:Collection',
+        'label': label,
+        'within': url,
+        'startIndex': offset,
+        'manifests': [],
+    }
+    if len(item_ids) > offset + collection_page_size:
+        collection['next'] = page_url(page + 1)
+    if page > 1:
+        collection['prev'] = page_url(page - 1)
 
-    return flask.render_template('iiif_region.html', items=items, items_without_image=items_without_image)
+    for item in load_items_and_property(page_item_ids, property_id):
+        if 'image_title' not in item:
+            continue  # no manifest
+        manifest = {
+            '@id': full_url('iiif_manifest_with_property', item_id=item['entity_id'], property_id=property_id),
+            '@type': 'sc:Manifest',
+            'label': {'@language': item['label']['language'], '@value': item['label']['value']},
+        }
+        if item['image_thumbnail'] is not None:
+            thumbnail_width, thumbnail_height = thumbnail_size(item, 400)
+            manifest['thumbnail'] = {
+                '@id': thumbnail_url(item, 400),
+                '@type': 'dctypes:Image',
+                'format': item['image_thumbnail']['mime'],
+                'width': thumbnail_width,
+                'height': thumbnail_height,
+            }
+        collection['manifests'].append(manifest)
+    return flask.jsonify(collection)
 
 @app.route('/file/<image_title>')
 def file(image_title):
@@ -375,10 +681,190 @@ def file(image_title):
 @app.route('/api/v1/depicteds_html/file/<image_title>')
 @enableCORS
 def file_depicteds_html(image_title):
-    file = load_file(image_title.replace('_', ' '))
-    if not file:
+    title = image_title.replace('_', ' ')
+    # the MediaInfo is requested in parallel with the revision, which costs no extra round trip even if it is not modified;
+    # the labels are only loaded if it is modified
+    files = load_files([title], fresh=True)
+    file = files[title]
+    if file is None:
         return flask.render_template('file-not-found.html', title=image_title), 404
-    return flask.render_template('depicteds.html', depicteds=file['depicteds'])
+    # the file page revision covers both the file and its MediaInfo
+    etag = revisions_etag(file['image_revision_id'])
+    if flask.request.if_none_match.contains(etag):
+        return not_modified(etag)
+    label_depicteds(files)
+    response = flask.make_response(flask.render_template('depicteds.html', depicteds=file['depicteds']))
+    return add_cache_validators(response, etag)
+
+@app.route('/api/v1/depicteds_regions/file/<image_title>')
+@enableCORS
+def file_depicteds_regions(image_title):
+    """The depicteds of a file with a region, as JSON, for hit-testing in the editor.
+
+    With ?point=x,y (in pixels, or pct:x,y), only the depicteds whose region contains the point;
+    otherwise, with ?region=<IIIF region>, only the depicteds whose region overlaps it.
+    The depicteds are sorted by region area, smallest (i.e. topmost) first;
+    duplicates lists pairs of statement IDs whose regions are almost the same."""
+    title = image_title.replace('_', ' ')
+    files = load_files([title], fresh=True)
+    file = files[title]
+    if file is None:
+        return 'File not found', 404
+    image_size = (file['image_width'], file['image_height'])
+    try:
+        point = parse_point(flask.request.args['point'], image_size) if 'point' in flask.request.args else None
+        region = Region.parse(flask.request.args['region']) if 'region' in flask.request.args else None
+    except ValueError as error:
+        return str(error), 400
+    etag = revisions_etag(file['image_revision_id'])
+    if flask.request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    depicteds = label_depicteds(files)[title]['depicteds']
+    index = RegionIndex(depicted_regions(depicteds, skip_invalid=True), depicteds, image_size)
+    if point is not None:
+        depicteds = index.containing(*point)
+    else:
+        depicteds = index.overlapping(region or Region.full(), image_size)
+    response = flask.jsonify(depicteds=depicteds,
+                             duplicates=[[first['statement_id'], second['statement_id']]
+                                         for first, second in index.duplicates()])
+    return add_cache_validators(response, etag)
+
+# maximum number of files in a queue (listed with one API request)
+queue_max_files = 500
+
+# queues of files to annotate one after the other, keyed by queue ID: {'label': …, 'titles': […]}
+_queues_cache = caches.make_cache(app.config.get('CACHE', {}), 'queues',
+                                  maxsize=app.config.get('QUEUES_CACHE_MAXSIZE', 1000),
+                                  ttl=app.config.get('QUEUES_CACHE_TTL', 24 * 60 * 60))
+
+# number of files after the current one that are prefetched in the background
+queue_prefetch_size = app.config.get('QUEUE_PREFETCH', 10)
+
+# files prefetched for the queue of each session (see create_queue()), per worker:
+# LRU caches from (language code, image title) to a future of (labeled) load_files() results
+_prefetched_files = cachetools.LRUCache(maxsize=app.config.get('QUEUE_SESSIONS_MAXSIZE', 100))
+_prefetched_files_lock = threading.Lock()
+
+# separate from the executor, so that prefetching never delays requests
+prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=app.config.get('QUEUE_PREFETCH_WORKERS', 2))
+
+def queue_titles(source, input):
+    """Get the titles of the files in a Commons category, search results or list of MediaInfo IDs, without File: prefix."""
+    session = anonymous_session('commons.wikimedia.org')
+    if source == 'category':
+        category = input if input.startswith('Category:') else 'Category:' + input
+        response = session.get(action='query',
+                               list='categorymembers',
+                               cmtitle=category,
+                               cmtype='file',
+                               cmlimit=queue_max_files)
+        titles = [member['title'] for member in response['query']['categorymembers']]
+    elif source == 'search':
+        response = session.get(action='query',
+                               list='search',
+                               srsearch=input,
+                               srnamespace=6,
+                               srlimit=queue_max_files,
+                               srprop='')
+        titles = [result['title'] for result in response['query']['search']]
+    elif source == 'ids':
+        page_ids = list(dict.fromkeys(int(page_id) for page_id in re.findall(r'\bM([1-9][0-9]*)\b', input)))[:queue_max_files]
+        titles_by_page_id = {}
+        for chunk in [page_ids[i:i + 50] for i in range(0, len(page_ids), 50)]:
+            response = session.get(action='query',
+                                   pageids=chunk)
+            titles_by_page_id.update((page['pageid'], page['title'])
+                                     for page in response['query']['pages']
+                                     if not page.get('missing', False) and page.get('ns') == 6)
+        titles = [titles_by_page_id[page_id] for page_id in page_ids if page_id in titles_by_page_id]
+    else:
+        flask.abort(400, Markup('Unknown queue source <kbd>{}</kbd>.').format(source))
+    return [title[len('File:'):] for title in titles]
+
+def create_queue(source, input):
+    """Create a queue of files for the current session and redirect to its first file.
+
+    The session’s previous queue is forgotten, along with its prefetched files."""
+    titles = queue_titles(source, input.strip())
+    if not titles:
+        return flask.render_template('queue-not-found.html', empty=True), 404
+    queue_id = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(16))
+    _queues_cache.set(queue_id, {'label': input, 'titles': titles})
+    previous_queue_id = flask.session.get('queue_id')
+    if previous_queue_id is not None:
+        with _prefetched_files_lock:
+            _prefetched_files.pop(previous_queue_id, None)
+    flask.session['queue_id'] = queue_id
+    return flask.redirect(flask.url_for('queue_file', queue_id=queue_id, position=1))
+
+def prefetch_queue_files(queue_id, image_titles):
+    """Start loading the given files of a queue in the background, unless they are already (being) prefetched."""
+    language = flask.g.interface_language_code
+    with _prefetched_files_lock:
+        prefetched = _prefetched_files.get(queue_id)
+        if prefetched is None:
+            # prefetched files that are not used soon are outdated, e.g. when the user takes a break
+            prefetched = _prefetched_files[queue_id] = cachetools.TTLCache(maxsize=2 * queue_prefetch_size,
+                                                                           ttl=app.config.get('QUEUE_PREFETCH_TTL', 10 * 60))
+        # a prefetch cancelled by take_prefetched_file() also covered other files, which are prefetched again
+        missing_image_titles = [image_title for image_title in image_titles
+                                if (language, image_title) not in prefetched or prefetched[(language, image_title)].cancelled()]
+        if not missing_image_titles:
+            return
+        future = prefetch_executor.submit(prefetch_files, language, missing_image_titles)
+        for image_title in missing_image_titles:
+            prefetched[(language, image_title)] = future
+
+def prefetch_files(language, image_titles):
+    with app.app_context():
+        flask.g.interface_language_code = language
+        return label_depicteds(load_files(image_titles))
+
+def take_prefetched_file(queue_id, image_title):
+    """Get a file prefetched by prefetch_queue_files(), waiting for it if it is still being loaded.
+
+    The file is removed from the prefetched files, so that it is loaded again
+    (with any edits since then) if the user comes back to it.
+    If the prefetch has not started yet (the prefetch pool is busy), it is cancelled
+    and the caller loads the file itself, rather than waiting for the queue.
+    Returns a (prefetched, file) tuple; file is None if the file does not exist."""
+    with _prefetched_files_lock:
+        prefetched = _prefetched_files.get(queue_id)
+        future = prefetched.pop((flask.g.interface_language_code, image_title), None) if prefetched is not None else None
+    if future is None:
+        return False, None
+    if not future.running() and future.cancel():
+        return False, None
+    try:
+        return True, future.result()[image_title]
+    except Exception:
+        # load the file again, so that the error (if it persists) is raised in the request
+        return False, None
+
+@app.route('/queue/<queue_id>/<int:position>')
+def queue_file(queue_id, position):
+    queue = _queues_cache.get(queue_id)
+    if queue is None:
+        return flask.render_template('queue-not-found.html', empty=False), 404
+    titles = queue['titles']
+    if not 1 <= position <= len(titles):
+        flask.abort(404)
+    image_title = titles[position - 1]
+    prefetched, file = take_prefetched_file(queue_id, image_title)
+    if not prefetched:
+        file = load_file(image_title)
+    prefetch_queue_files(queue_id, titles[position:position + queue_prefetch_size])
+    # a file may have been deleted since the queue was created, the other files can still be annotated
+    return flask.render_template('queue.html',
+                                 file=file,
+                                 image_title=image_title,
+                                 queue_label=queue['label'],
+                                 position=position,
+                                 count=len(titles),
+                                 previous_position=position - 1 if position > 1 else None,
+                                 next_position=position + 1 if position < len(titles) else None), 200 if file else 404
 
 @app.route('/api/v1/add_statement/<domain>', methods=['POST'])
 def api_add_statement(domain):
@@ -409,7 +895,6 @@ def api_add_statement(domain):
     if session is None:
         return 'Not logged in', 403
 
-    token = session.get(action='query', meta='tokens', type='csrf')['query']['tokens']['csrftoken']
     depicted = {
         'snaktype': snaktype,
         'property_id': property_id,
@@ -428,12 +913,12 @@ def api_add_statement(domain):
         else:
             raise ValueError('Unknown snaktype')
     try:
-        response = session.post(action='wbcreateclaim',
-                                entity=entity_id,
-                                snaktype=snaktype,
-                                property=property_id,
-                                value=value,
-                                token=token)
+        response = post_with_csrf_token(session, domain,
+                                        action='wbcreateclaim',
+                                        entity=entity_id,
+                                        snaktype=snaktype,
+                                        property=property_id,
+                                        value=value)
     except mwapi.errors.APIError as error:
         return str(error), 500
     statement_id = response['claim']['id']
@@ -449,6 +934,10 @@ def api_add_qualifier(domain):
     qualifier_hash = flask.request.form.get('qualifier_hash')  # optional
     if not statement_id or not iiif_region or not request_csrf_token:
         return 'Incomplete form data', 400
+    try:
+        iiif_region = normalize(iiif_region)
+    except ValueError:
+        return 'Invalid IIIF region', 400
 
     if request_csrf_token != csrf_token():
         return 'Wrong CSRF token (try reloading the page).', 403
@@ -463,41 +952,155 @@ def api_add_qualifier(domain):
     if session is None:
         return 'Not logged in', 403
 
-    token = session.get(action='query', meta='tokens', type='csrf')['query']['tokens']['csrftoken']
     try:
-        response = session.post(action='wbsetqualifier', claim=statement_id, property='P2677',
-                                snaktype='value', value=('"' + iiif_region + '"'),
-                                **({'snakhash': qualifier_hash} if qualifier_hash else {}),
-                                summary='region drawn manually using [[d:User:Lucas Werkmeister/Wikidata Image Positions|Wikidata Image Positions tool]]',
-                                token=token)
+        new_qualifier_hash = set_region_qualifier(session, domain, statement_id, iiif_region, qualifier_hash)
     except mwapi.errors.APIError as error:
-        if error.code == 'no-such-qualifier':
-            return 'This region does not exist (anymore) – it may have been edited in the meantime. Please try reloading the page.', 500
-        return str(error), 500
+        return region_qualifier_error_message(error), 500
+    return flask.jsonify(qualifier_hash=new_qualifier_hash)
+
+@app.route('/api/v3/add_qualifiers/<domain>', methods=['POST'])
+def api_add_qualifiers(domain):
+    """Add or edit several region qualifiers at once.
+
+    The qualifiers form field is a JSON list of objects
+    with statement_id, iiif_region and (optional) qualifier_hash members (all strings),
+    at most max_qualifiers_per_request of them;
+    the response has one result per qualifier, in the same order,
+    with either the new qualifier_hash or an error message
+    (and retry: true if the qualifier was skipped because of the time limit)."""
+    request_csrf_token = flask.request.form.get('_csrf_token')
+    try:
+        qualifiers = json.loads(flask.request.form.get('qualifiers', ''))
+    except ValueError:
+        return 'Invalid qualifiers JSON', 400
+    if not isinstance(qualifiers, list) or not request_csrf_token:
+        return 'Incomplete form data', 400
+    if len(qualifiers) > max_qualifiers_per_request:
+        return 'Too many qualifiers', 400
+    for qualifier in qualifiers:
+        if not isinstance(qualifier, dict) or not qualifier.get('statement_id') or not qualifier.get('iiif_region'):
+            return 'Incomplete form data', 400
+        if not all(isinstance(qualifier.get(key, ''), str) for key in ['statement_id', 'iiif_region', 'qualifier_hash']):
+            return 'Invalid form data', 400
+        try:
+            qualifier['iiif_region'] = normalize(qualifier['iiif_region'])
+        except ValueError:
+            return 'Invalid IIIF region', 400
+
+    if request_csrf_token != csrf_token():
+        return 'Wrong CSRF token (try reloading the page).', 403
+
+    if not flask.request.referrer.startswith(full_url('index')):
+        return 'Wrong Referer header', 403
+
+    if domain not in {'www.wikidata.org', 'commons.wikimedia.org'}:
+        return 'Unsupported domain', 403
+
+    session = authenticated_session(domain)
+    if session is None:
+        return 'Not logged in', 403
+
+    # edits to the same entity are made one after the other (to avoid edit conflicts),
+    # edits to different entities in parallel (in the edit pool), all with the same CSRF token;
+    # qualifiers that are not edited before the time limit get an error with retry set,
+    # so the client can send them again in another request
+    indices_by_entity = collections.defaultdict(list)
+    for index, qualifier in enumerate(qualifiers):
+        entity_id = qualifier['statement_id'].split('$', 1)[0].upper()
+        indices_by_entity[entity_id].append(index)
+    wiki_csrf_token(session, domain)
+
+    results = [None] * len(qualifiers)
+    deadline = time.monotonic() + add_qualifiers_time_limit
+
+    def set_entity_qualifiers(indices):
+        for index in indices:
+            qualifier = qualifiers[index]
+            result = {'statement_id': qualifier['statement_id']}
+            if time.monotonic() > deadline:
+                result['error'] = 'This region was not saved because the request took too long. Please try again.'
+                result['retry'] = True
+                results[index] = result
+                continue
+            try:
+                result['qualifier_hash'] = set_region_qualifier(session, domain,
+                                                                qualifier['statement_id'],
+                                                                qualifier['iiif_region'],
+                                                                qualifier.get('qualifier_hash'))
+            except mwapi.errors.APIError as error:
+                result['error'] = region_qualifier_error_message(error)
+            results[index] = result
+
+    run_concurrently(*(functools.partial(set_entity_qualifiers, indices)
+                       for indices in indices_by_entity.values()),
+                     pool=edit_executor)
+    return flask.jsonify(results=results)
+
+def set_region_qualifier(session, domain, statement_id, iiif_region, qualifier_hash=None):
+    """Add or edit a region qualifier and return its new hash (or None if it cannot be found)."""
+    response = post_with_csrf_token(session, domain,
+                                    action='wbsetqualifier', claim=statement_id, property='P2677',
+                                    snaktype='value', value=('"' + iiif_region + '"'),
+                                    **({'snakhash': qualifier_hash} if qualifier_hash else {}),
+                                    summary='region drawn manually using [[d:User:Lucas Werkmeister/Wikidata Image Positions|Wikidata Image Positions tool]]')
     # find hash of qualifier
     for qualifier in response['claim']['qualifiers']['P2677']:
         if qualifier['snaktype'] == 'value' and qualifier['datavalue']['value'] == iiif_region:
-            return flask.jsonify(qualifier_hash=qualifier['hash'])
-    return flask.jsonify(qualifier_hash=None)
+            return qualifier['hash']
+    return None
+
+def region_qualifier_error_message(error):
+    if error.code == 'no-such-qualifier':
+        return 'This region does not exist (anymore) – it may have been edited in the meantime. Please try reloading the page.'
+    return str(error)
+
+def revisions_etag(*revision_ids):
+    """Get a strong ETag for a response built from the given revisions
+    in the current interface language."""
+    return '-'.join([*(str(revision_id) for revision_id in revision_ids),
+                     flask.g.interface_language_code])
+
+def not_modified(etag):
+    response = flask.Response(status=304)
+    return add_cache_validators(response, etag)
+
+def add_cache_validators(response, etag):
+    """Add the ETag and caching headers to a response, so clients and proxies can revalidate it."""
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get('JSON_MAX_AGE', 5 * 60)
+    # the interface language comes from ?uselang=, the session, or the Accept-Language header
+    response.vary.update(['Accept-Language', 'Cookie'])
+    return response
 
 @app.route('/healthz')
 def health():
     return ''
 
+@app.route('/healthz/caches')
+def health_caches():
+    return flask.jsonify(labels=labels_cache_info())
+
+@app.route('/healthz/connections')
+def health_connections():
+    return flask.jsonify(http_connection_info())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    body, content_type = metrics.exposition()
+    return flask.Response(body, content_type=content_type)
+
+@app.route('/healthz/timing')
+def health_timing():
+    return flask.jsonify(buckets_ms=tracing.histogram_buckets,
+                         histograms=tracing.histograms())
+
 
 # https://iiif.io/api/image/2.0/#region
 @app.template_filter()
 def iiif_region_to_style(iiif_region):
     try:
-        if iiif_region == 'full':
-            return 'left: 0px; top: 0px; width: 100%; height: 100%;'
-        if iiif_region.startswith('pct:'):
-            left, top, width, height = iiif_region[len('pct:'):].split(',')
-            z_index = int(1_000_000 / (float(width) * float(height)))
-            return 'left: %s%%; top: %s%%; width: %s%%; height: %s%%; z-index: %s;' % (left, top, width, height, z_index)
-        left, top, width, height = iiif_region.split(',')
-        z_index = int(1_000_000_000 / (int(width) * int(height)))
-        return 'left: %spx; top: %spx; width: %spx; height: %spx; z-index: %s;' % (left, top, width, height, z_index)
+        return Region.parse(iiif_region).style()
     except ValueError:
         flask.abort(400, Markup('Invalid IIIF region <kbd>{}</kbd> encountered. Remove the invalid qualifier manually, then reload.').format(iiif_region))
 
@@ -591,121 +1194,280 @@ def handle_wrong_data_value_type(error):
 
 
 def load_item_and_property(item_id, property_id,
-                           include_depicteds=False, include_description=False, include_metadata=False):
-    props = ['claims']
-    if include_description:
-        props.append('descriptions')
+                           include_depicteds=False, include_description=False, include_metadata=False,
+                           include_depicted_labels=True):
+    [item] = load_items_and_property([item_id], property_id,
+                                     include_depicteds=include_depicteds,
+                                     include_description=include_description,
+                                     include_metadata=include_metadata,
+                                     include_depicted_labels=include_depicted_labels)
+    return item
 
-    session = anonymous_session('www.wikidata.org')
-    api_response = session.get(action='wbgetentities',
-                               props=props,
-                               ids=item_id,
-                               languages=[flask.g.interface_language_code],
-                               languagefallback=True)
-    item_data = api_response['entities'][item_id]
-    item = {
-        'entity_id': item_id,
-    }
-    entity_ids = [item_id]
+def load_items_and_property(item_ids, property_id,
+                            include_depicteds=False, include_description=False, include_metadata=False,
+                            include_depicted_labels=True):
+    """Load several items, with one wbgetentities request per 50 items,
+    one imageinfo query per 50 images, and one batch of labels for everything.
 
-    if include_description:
-        item['description'] = item_data.get('descriptions', {})\
-                                       .get(flask.g.interface_language_code)
+    With include_depicted_labels=False, the depicteds have no labels
+    (the caller loads them later, e.g. in chunks)."""
+    items_data = load_items_data(item_ids, include_description=include_description)
 
-    image_datavalue = best_value(item_data, property_id)
-    if image_datavalue is not None:
-        if image_datavalue['type'] != 'string':
-            raise WrongDataValueType(expected_data_value_type='string', actual_data_value_type=image_datavalue['type'])
-        image_title = image_datavalue['value']
-        item.update(load_image(image_title))
-
-    if include_depicteds:
-        depicteds = depicted_items(item_data)
-        for depicted in depicteds:
-            if 'item_id' in depicted:
-                entity_ids.append(depicted['item_id'])
+    items = []
+    entity_ids = list(item_ids)
+    image_titles = []
+    for item_id in item_ids:
+        item_data = items_data[item_id]
+        item = {
+            'entity_id': item_id,
+            'revision_id': item_data['lastrevid'],
+        }
 
-    if include_metadata:
-        metadata = entity_metadata(item_data)
-        entity_ids += metadata.keys()
+        if include_description:
+            item['description'] = item_data.get('descriptions', {})\
+                                           .get(flask.g.interface_language_code)
 
-    labels = load_labels(entity_ids)
-    item['label'] = labels[item_id]
+        image_datavalue = best_value(item_data, property_id)
+        if image_datavalue is not None:
+            if image_datavalue['type'] != 'string':
+                raise WrongDataValueType(expected_data_value_type='string', actual_data_value_type=image_datavalue['type'])
+            item['image_title'] = image_datavalue['value']
+            image_titles.append(item['image_title'])
 
-    if include_depicteds:
-        for depicted in depicteds:
-            depicted['label'] = depicted_label(depicted, labels)
-        item['depicteds'] = depicteds
+        if include_depicteds:
+            item['depicteds'] = depicted_items(item_data)
+            if include_depicted_labels:
+                for depicted in item['depicteds']:
+                    if 'item_id' in depicted:
+                        entity_ids.append(depicted['item_id'])
+
+        items.append(item)
 
     if include_metadata:
-        item['metadata'] = []
-        for property_id, values in metadata.items():
-            for value in values:
-                item['metadata'].append({
-                    'label': labels[property_id],
-                    'value': value
-                })
+        entity_ids += metadata_property_ids
+
+    # the formatted metadata, images and labels are independent of each other
+    metadatas, images, labels = run_concurrently(
+        lambda: [entity_metadata(items_data[item_id]) if include_metadata else None
+                 for item_id in item_ids],
+        lambda: load_images(image_titles),
+        lambda: load_labels(entity_ids),
+    )
+    for item, metadata in zip(items, metadatas):
+        if include_metadata:
+            item['metadata'] = metadata
+
+    for item in items:
+        if 'image_title' in item:
+            image = images[item['image_title']]
+            if image is None:
+                del item['image_title']
+            else:
+                item.update(image)
 
-    return item
+        item['label'] = labels[item['entity_id']]
 
-def load_file(image_title):
-    image = load_image(image_title)
-    if image is None:
-        return None
+        if include_depicteds and include_depicted_labels:
+            for depicted in item['depicteds']:
+                depicted['label'] = depicted_label(depicted, labels)
 
-    entity_id = 'M' + str(image['image_page_id'])
-    file = {
-        'entity_id': entity_id,
-        **image,
-    }
-    entity_ids = []
+        if include_metadata:
+            metadata = item['metadata']
+            item['metadata'] = []
+            for metadata_property_id, values in metadata.items():
+                for value in values:
+                    item['metadata'].append({
+                        'label': labels[metadata_property_id],
+                        'value': value
+                    })
 
-    session = anonymous_session('commons.wikimedia.org')
-    api_response = session.get(action='wbgetentities',
-                               props=['claims'],
-                               ids=[entity_id])
-    file_data = api_response['entities'][entity_id]
+    return items
 
-    depicteds = depicted_items(file_data)
-    for depicted in depicteds:
-        if 'item_id' in depicted:
-            entity_ids.append(depicted['item_id'])
+def load_items_data(item_ids, include_description=False):
+    """Load the entity data of several items, with one wbgetentities request per 50 items.
 
-    labels = load_labels(entity_ids)
+    The data is memoized for the rest of the request."""
+    props = ['info', 'claims']
+    if include_description:
+        props.append('descriptions')
 
+    items_data = request_cache('items_data_' + '|'.join(props))
+    missing_item_ids = [item_id for item_id in dict.fromkeys(item_ids) if item_id not in items_data]
+
+    session = anonymous_session('www.wikidata.org')
+    for chunk in [missing_item_ids[i:i + 50] for i in range(0, len(missing_item_ids), 50)]:
+        api_response = session.get(action='wbgetentities',
+                                   props=props,
+                                   ids=chunk,
+                                   languages=[flask.g.interface_language_code],
+                                   languagefallback=True)
+        items_data.update(api_response['entities'])
+
+    return {item_id: items_data[item_id] for item_id in item_ids}
+
+def load_revisions(item_id, property_id, include_description=False):
+    """Load the current revision IDs of an item and of its image (for the given property).
+
+    Returns None if the item has no image (or the image file does not exist).
+    This is a cheap check: the item and image are requested the same way
+    load_item_and_property() would, so it reuses the data for the rest of the request,
+    but the image info is not taken from the cache, since it might be outdated."""
+    item_data = load_items_data([item_id], include_description=include_description)[item_id]
+    image_datavalue = best_value(item_data, property_id)
+    if image_datavalue is None:
+        return None
+    if image_datavalue['type'] != 'string':
+        raise WrongDataValueType(expected_data_value_type='string', actual_data_value_type=image_datavalue['type'])
+    image_title = image_datavalue['value']
+    image = load_images([image_title], fresh=True)[image_title]
+    if image is None:
+        return None
+    return item_data['lastrevid'], image['image_revision_id']
+
+def load_file(image_title, fresh=False):
+    return label_depicteds(load_files([image_title], fresh=fresh))[image_title]
+
+def load_files(image_titles, fresh=False):
+    """Load several files with their depicteds, but without the labels of the depicteds (see label_depicteds()).
+
+    The image info and the MediaInfo (looked up by title, since the page ID is not known yet)
+    are requested in parallel, with one request per 50 files each.
+    Returns a dict from image title to file, or None if the file does not exist.
+    If fresh is set, the image info is not taken from the cache (see load_images())."""
+    unique_image_titles = list(dict.fromkeys(image_titles))
+    images, *files_data_chunks = run_concurrently(
+        lambda: load_images(unique_image_titles, fresh=fresh),
+        *[functools.partial(load_files_data, unique_image_titles[i:i + 50]) for i in range(0, len(unique_image_titles), 50)],
+    )
+    files_data = {}
+    for files_data_chunk in files_data_chunks:
+        files_data.update(files_data_chunk)
+    entity_ids = {image_title: 'M' + str(image['image_page_id'])
+                  for image_title, image in images.items()
+                  if image is not None}
+
+    # e.g. if the file was moved between the two requests, look up the MediaInfo by ID after all
+    missing_entity_ids = [entity_id for entity_id in dict.fromkeys(entity_ids.values()) if entity_id not in files_data]
+    session = anonymous_session('commons.wikimedia.org')
+    for chunk in [missing_entity_ids[i:i + 50] for i in range(0, len(missing_entity_ids), 50)]:
+        api_response = session.get(action='wbgetentities',
+                                   props=['claims'],
+                                   ids=chunk)
+        files_data.update(api_response['entities'])
+
+    files = {}
+    for image_title in image_titles:
+        if images[image_title] is None:
+            files[image_title] = None
+            continue
+        files[image_title] = {
+            'entity_id': entity_ids[image_title],
+            **images[image_title],
+            'depicteds': depicted_items(files_data[entity_ids[image_title]]),
+        }
+    return files
+
+def label_depicteds(files):
+    """Add the labels to the depicteds of files loaded by load_files(), with one request per 50 labels not in the cache.
+
+    Returns the same dict of files."""
+    depicteds = [depicted
+                 for file in files.values()
+                 if file is not None
+                 for depicted in file['depicteds']]
+    labels = load_labels(depicted['item_id'] for depicted in depicteds if 'item_id' in depicted)
     for depicted in depicteds:
         depicted['label'] = depicted_label(depicted, labels)
-    file['depicteds'] = depicteds
+    return files
 
-    return file
+def load_files_data(image_titles):
+    """Load the MediaInfo entities of up to 50 files by title, with one wbgetentities request.
 
-def load_image(image_title):
-    """Load the metadata of an image file on Commons, without structured data."""
+    Returns a dict from entity ID to entity data
+    (for files without structured data, an entity marked as missing);
+    pages that do not exist are left out."""
     session = anonymous_session('commons.wikimedia.org')
+    api_response = session.get(action='wbgetentities',
+                               props=['info', 'claims'],
+                               sites='commonswiki',
+                               titles=['File:' + image_title for image_title in image_titles])
+    return {entity['id']: entity
+            for entity in api_response['entities'].values()
+            if 'id' in entity}
+
+# images loaded by load_image(), keyed by language code (for the attribution) and title
+_images_cache = caches.make_cache(app.config.get('CACHE', {}), 'images',
+                                  maxsize=app.config.get('IMAGES_CACHE_MAXSIZE', 10_000),
+                                  ttl=app.config.get('IMAGES_CACHE_TTL', 60 * 60))
 
-    query_params = query_default_params()
-    query_params.setdefault('titles', set()).update(['File:' + image_title])
-    image_attribution_query_add_params(query_params, image_title)
-    image_url_query_add_params(query_params, image_title)
-    image_size_query_add_params(query_params, image_title)
+def load_image(image_title):
+    """Load the metadata of an image file on Commons, without structured data.
 
-    query_response = session.get(**query_params)
-    page = query_response_page(query_response, 'File:' + image_title)
-    if page.get('missing', False) or page.get('invalid', False):
-        return None
+    All the image info needed anywhere in the tool (attribution, URL, size, thumbnail)
+    is requested in one query, and the result is memoized for the rest of the request
+    (as well as cached across requests)."""
+    return load_images([image_title])[image_title]
 
-    page_id = page['pageid']
-    attribution = image_attribution_query_process_response(query_response, image_title)
-    url = image_url_query_process_response(query_response, image_title)
-    width, height = image_size_query_process_response(query_response, image_title)
-    return {
-        'image_page_id': page_id,
-        'image_title': image_title,
-        'image_attribution': attribution,
-        'image_url': url,
-        'image_width': width,
-        'image_height': height,
-    }
+def load_images(image_titles, fresh=False):
+    """Load the metadata of several image files, with one query per 50 files.
+
+    Returns a dict from image title to image (see load_image()),
+    or None if the file does not exist.
+    If fresh is set, images are not taken from the cache (but still memoized for the request)."""
+    images = request_cache('images')
+    missing_image_titles = [image_title for image_title in set(image_titles) if image_title not in images]
+
+    language = flask.g.interface_language_code
+    if fresh:
+        cached_images = {}
+    else:
+        cached_images = _images_cache.get_many([language + ':' + image_title for image_title in missing_image_titles])
+    for key, image in cached_images.items():
+        if image['image_attribution'] is not None:
+            # the cache stores JSON, restore the Markup
+            image['image_attribution']['attribution_html'] = Markup(image['image_attribution']['attribution_html'])
+        images[key[len(language + ':'):]] = image
+    missing_image_titles = [image_title for image_title in missing_image_titles if image_title not in images]
+
+    session = anonymous_session('commons.wikimedia.org')
+    for chunk in [missing_image_titles[i:i + 50] for i in range(0, len(missing_image_titles), 50)]:
+        query_params = query_default_params()
+        for image_title in chunk:
+            query_params.setdefault('titles', set()).update(['File:' + image_title])
+            image_attribution_query_add_params(query_params, image_title)
+            image_url_query_add_params(query_params, image_title)
+            image_size_query_add_params(query_params, image_title)
+            image_thumbnail_query_add_params(query_params, image_title)
+            image_revision_query_add_params(query_params, image_title)
+
+        query_response = session.get(**query_params)
+        new_images = {}
+        for image_title in chunk:
+            page = query_response_page(query_response, 'File:' + image_title)
+            if page.get('missing', False) or page.get('invalid', False):
+                images[image_title] = None
+                continue
+
+            page_id = page['pageid']
+            attribution = image_attribution_query_process_response(query_response, image_title)
+            url = image_url_query_process_response(query_response, image_title)
+            width, height = image_size_query_process_response(query_response, image_title)
+            thumbnail = image_thumbnail_query_process_response(query_response, image_title)
+            revision_id = image_revision_query_process_response(query_response, image_title)
+            new_images[image_title] = {
+                'image_page_id': page_id,
+                'image_title': image_title,
+                'image_attribution': attribution,
+                'image_url': url,
+                'image_width': width,
+                'image_height': height,
+                'image_thumbnail': thumbnail,
+                'image_revision_id': revision_id,
+            }
+        images.update(new_images)
+        _images_cache.set_many({language + ':' + image_title: image for image_title, image in new_images.items()})
+
+    return {image_title: images[image_title] for image_title in image_titles}
 
 def depicted_label(depicted, labels):
     if 'item_id' in depicted:
@@ -717,13 +1479,9 @@ def depicted_label(depicted, labels):
     else:
         raise ValueError('depicted has neither item ID nor somevalue/novalue snaktype')
 
-def load_image_info(image_title):
-    file_title = 'File:' + image_title.replace(' ', '_')
-    session = anonymous_session('commons.wikimedia.org')
-    response = session.get(action='query', prop='imageinfo', iiprop='url|mime',
-                           iiurlwidth=8000, titles=file_title)
-
-    return response['query']['pages'][0]['imageinfo'][0]
+def request_cache(name):
+    """Get a dict to memoize data in for the rest of the current request."""
+    return flask.g.setdefault('request_cache_' + name, {})
 
 def full_url(endpoint, **kwargs):
     return flask.url_for(endpoint, _external=True, _scheme=flask.request.headers.get('X-Forwarded-Proto', 'http'), **kwargs)
@@ -750,7 +1508,7 @@ def build_manifest(item):
         manifest.label = iiif_item_label
     if iiif_item_description is not None:
         manifest.description = iiif_item_description
-    attribution = image_attribution(item['image_title'])
+    attribution = item['image_attribution']
     if attribution is not None:
         manifest.attribution = attribution['attribution_text']
         manifest.license = attribution['license_url']
@@ -770,27 +1528,52 @@ def build_manifest(item):
     return manifest
 
 def populate_canvas(canvas, item, fac):
-    image_info = load_image_info(item['image_title'])
-    width, height = image_info['thumbwidth'], image_info['thumbheight']
+    thumbnail = item['image_thumbnail']
+    width, height = canvas_size(item)
     canvas.set_hw(height, width)
     anno = canvas.annotation(ident='a0')
-    img = anno.image(ident=image_info['thumburl'], iiif=False)
+    if thumbnail is None:
+        # no thumbnails (e.g. for some audio or video files), use the original file
+        img = anno.image(ident=item['image_url'], iiif=False)
+        img.set_hw(height, width)
+        return
+    img = anno.image(ident=thumbnail['url'], iiif=False)
     img.set_hw(height, width)
-    img.format = image_info['mime']
+    img.format = thumbnail['mime']
 
     # add a thumbnail to the canvas
-    thumbs_path = image_info['thumburl'].replace('/wikipedia/commons/', '/wikipedia/commons/thumb/')
-    thumb_400 = thumbs_path + '/400px-' + item['image_title']
-    canvas.thumbnail = fac.image(ident=thumb_400)
-    canvas.thumbnail.format = image_info['mime']
-    thumbwidth, thumbheight = 400, int(height * (400 / width))
+    canvas.thumbnail = fac.image(ident=thumbnail_url(item, 400))
+    canvas.thumbnail.format = thumbnail['mime']
+    thumbwidth, thumbheight = thumbnail_size(item, 400)
     canvas.thumbnail.set_hw(thumbheight, thumbwidth)
 
+def canvas_size(item):
+    """The size of the canvas for the item’s image: the size of the largest thumbnail, or else of the file."""
+    thumbnail = item['image_thumbnail']
+    if thumbnail is None:
+        return int(item['image_width']), int(item['image_height'])
+    return int(thumbnail['width']), int(thumbnail['height'])
+
+def thumbnail_url(item, width):
+    thumbs_path = item['image_thumbnail']['url'].replace('/wikipedia/commons/', '/wikipedia/commons/thumb/')
+    return thumbs_path + '/' + str(width) + 'px-' + item['image_title']
+
+def thumbnail_size(item, width):
+    thumbnail = item['image_thumbnail']
+    return width, int(thumbnail['height'] * (width / thumbnail['width']))
+
+def entity_statements(entity_data):
+    """The statements of an entity by property ID, for items (claims) as well as MediaInfo (statements)."""
+    statements = entity_data.get('claims', entity_data.get('statements', {}))
+    if statements == []:
+        statements = {}  # T222159
+    return statements
+
 def best_value(entity_data, property_id):
-    if property_id not in entity_data['claims']:
+    statements = entity_statements(entity_data).get(property_id)
+    if not statements:
         return None
 
-    statements = entity_data['claims'][property_id]
     normal_value = None
     deprecated_value = None
 
@@ -809,10 +1592,10 @@ def best_value(entity_data, property_id):
     return normal_value or deprecated_value
 
 def best_values(entity_data, property_id):
-    if property_id not in entity_data['claims']:
+    statements = entity_statements(entity_data).get(property_id)
+    if not statements:
         return []
 
-    statements = entity_data['claims'][property_id]
     preferred_values = []
     normal_values = []
     deprecated_values = []
@@ -834,9 +1617,7 @@ def best_values(entity_data, property_id):
 def depicted_items(entity_data):
     depicteds = []
 
-    statements = entity_data.get('claims', entity_data.get('statements', {}))
-    if statements == []:
-        statements = {}  # T222159
+    statements = entity_statements(entity_data)
     for property_id in depicted_properties:
         for statement in statements.get(property_id, []):
             snaktype = statement['mainsnak']['snaktype']
@@ -858,63 +1639,116 @@ def depicted_items(entity_data):
             depicteds.append(depicted)
     return depicteds
 
-def entity_metadata(entity_data):
-    # property IDs based on https://www.wikidata.org/wiki/Wikidata:WikiProject_Visual_arts/Item_structure#Describing_individual_objects
-    property_ids = [
-        'P170',  # creator
-        'P1476',  # title
-        'P571',  # inception
-        'P186',  # material used
-        'P2079',  # fabrication method
-        'P2048',  # height
-        'P2049',  # width
-        'P2610',  # thickness
-        'P88',  # commissioned by
-        'P1071',  # location of final assembly
-        'P127',  # owned by
-        'P1259',  # coordinates of the point of view
-        'P195',  # collection
-        'P276',  # location
-        'P635',  # coordinate location
-        'P1684',  # inscription
-        'P136',  # genre
-        'P135',  # movement
-        'P921',  # main subject
-        'P144',  # based on
-        'P941',  # inspired by
-    ]
-    metadata = collections.defaultdict(list)
+# property IDs based on https://www.wikidata.org/wiki/Wikidata:WikiProject_Visual_arts/Item_structure#Describing_individual_objects
+metadata_property_ids = [
+    'P170',  # creator
+    'P1476',  # title
+    'P571',  # inception
+    'P186',  # material used
+    'P2079',  # fabrication method
+    'P2048',  # height
+    'P2049',  # width
+    'P2610',  # thickness
+    'P88',  # commissioned by
+    'P1071',  # location of final assembly
+    'P127',  # owned by
+    'P1259',  # coordinates of the point of view
+    'P195',  # collection
+    'P276',  # location
+    'P635',  # coordinate location
+    'P1684',  # inscription
+    'P136',  # genre
+    'P135',  # movement
+    'P921',  # main subject
+    'P144',  # based on
+    'P941',  # inspired by
+]
 
-    session = anonymous_session('www.wikidata.org')
-    for property_id in property_ids:
+def entity_metadata(entity_data):
+    language = flask.g.interface_language_code
+    futures = collections.defaultdict(list)
+    for property_id in metadata_property_ids:
         for value in best_values(entity_data, property_id):
-            response = session.get(action='wbformatvalue',
-                                   generate='text/html',
-                                   datavalue=json.dumps(value),
-                                   property=property_id)
-            metadata[property_id].append(response['result'])
+            # with the current context, like run_concurrently(), so that the API requests are traced
+            futures[property_id].append(executor.submit(contextvars.copy_context().run,
+                                                        format_value,
+                                                        json.dumps(value, sort_keys=True),
+                                                        property_id,
+                                                        language))
+
+    metadata = {}
+    for property_id, property_futures in futures.items():
+        metadata[property_id] = [future.result() for future in property_futures]
 
     return metadata
 
+@cachetools.cached(cache=cachetools.TTLCache(maxsize=10_000, ttl=24 * 60 * 60),
+                   lock=threading.RLock(),
+                   info=True)
+def format_value(datavalue, property_id, language):
+    """Format a data value (as JSON) as HTML in the given language.
+
+    The result is cached, since the same values (creators, collections, materials…)
+    show up on many items; entity_metadata() calls this in parallel.
+    """
+    session = anonymous_session('www.wikidata.org')
+    response = session.get(action='wbformatvalue',
+                           generate='text/html',
+                           datavalue=datavalue,
+                           property=property_id,
+                           uselang=language)
+    return response['result']
+
+# labels of individual entities, keyed by language code and entity ID;
+# entities without a label are cached as well, with the same fallback load_labels() returns
+_labels_cache = caches.make_cache(app.config.get('CACHE', {}), 'labels',
+                                  maxsize=app.config.get('LABELS_CACHE_MAXSIZE', 100_000),
+                                  ttl=app.config.get('LABELS_CACHE_TTL', 60 * 60))
+
 def load_labels(entity_ids):
-    """Load the labels of the given entity IDs in the interface language."""
-    entity_ids = list(set(entity_ids))
-    labels = {}
+    """Load the labels of the given entity IDs in the interface language.
+
+    Labels are cached (see labels_cache_info()),
+    and only the labels missing from the cache are requested from Wikidata.
+    """
+    language = flask.g.interface_language_code
+    entity_ids = set(entity_ids)
+    cached_labels = _labels_cache.get_many([language + ':' + entity_id for entity_id in entity_ids])
+    labels = {key[len(language + ':'):]: label for key, label in cached_labels.items()}
+    missing_entity_ids = [entity_id for entity_id in entity_ids if entity_id not in labels]
+
     session = anonymous_session('www.wikidata.org')
-    for chunk in [entity_ids[i:i + 50] for i in range(0, len(entity_ids), 50)]:
+    for chunk in [missing_entity_ids[i:i + 50] for i in range(0, len(missing_entity_ids), 50)]:
         items_data = session.get(action='wbgetentities',
                                  props='labels',
-                                 languages=[flask.g.interface_language_code],
+                                 languages=[language],
                                  languagefallback=True,
                                  ids=chunk)['entities']
+        new_labels = {}
         for entity_id, item_data in items_data.items():
-            labels[entity_id] = item_data.get('labels', {})\
-                                         .get(flask.g.interface_language_code,
-                                              {'language': 'zxx', 'value': entity_id})
+            new_labels[entity_id] = item_data.get('labels', {})\
+                                             .get(language,
+                                                  {'language': 'zxx', 'value': entity_id})
+        labels.update(new_labels)
+        _labels_cache.set_many({language + ':' + entity_id: label for entity_id, label in new_labels.items()})
     return labels
 
-@cachetools.cached(cache=cachetools.TTLCache(maxsize=1000, ttl=7 * 24 * 60 * 60),
-                   lock=threading.RLock())
+def labels_cache_info():
+    """Get statistics about the load_labels() cache, as seen by this process.
+
+    The size is only available for the (default) memory cache backend."""
+    info = {
+        'hits': _labels_cache.hits,
+        'misses': _labels_cache.misses,
+    }
+    if isinstance(_labels_cache, caches.MemoryCache):
+        info['currsize'] = _labels_cache.currsize
+        info['maxsize'] = _labels_cache.maxsize
+    return info
+
+_depicted_properties_labels_cache = caches.make_cache(app.config.get('CACHE', {}), 'depicted_properties_labels',
+                                                      maxsize=1, ttl=7 * 24 * 60 * 60)
+
 def depicted_properties_labels():
     """Load the labels of the depicted_properties in all available interface languages.
 
@@ -923,6 +1757,10 @@ def depicted_properties_labels():
     whereas individual entity labels loaded by load_labels()
     are probably only needed for one request.
     """
+    labels = _depicted_properties_labels_cache.get('labels')
+    if labels is not None:
+        return labels
+
     assert len(depicted_properties) <= 50
     property_ids = list(depicted_properties.keys())
     languages = list(i18n.translations.keys())
@@ -937,6 +1775,7 @@ def depicted_properties_labels():
         for property_id, property_data in properties_data.items():
             labels.setdefault(property_id, {})\
                   .update(property_data['labels'])
+    _depicted_properties_labels_cache.set('labels', labels)
     return labels
 
 @app.template_global(name='depicted_properties_labels')
@@ -948,11 +1787,7 @@ def depicted_properties_labels_in_interface_language():
     }
 
 def image_attribution(image_title):
-    params = query_default_params()
-    image_attribution_query_add_params(params, image_title)
-    session = anonymous_session('commons.wikimedia.org')
-    response = session.get(**params)
-    return image_attribution_query_process_response(response, image_title)
+    return load_image(image_title)['image_attribution']
 
 def image_attribution_query_add_params(params, image_title):
     params.setdefault('prop', set()).update(['imageinfo'])
@@ -996,11 +1831,7 @@ def image_attribution_query_process_response(response, image_title):
     }
 
 def image_url(image_title):
-    params = query_default_params()
-    image_url_query_add_params(params, image_title)
-    session = anonymous_session('commons.wikimedia.org')
-    response = session.get(**params)
-    return image_url_query_process_response(response, image_title)
+    return load_image(image_title)['image_url']
 
 def image_url_query_add_params(params, image_title):
     params.setdefault('prop', set()).update(['imageinfo'])
@@ -1015,11 +1846,8 @@ def image_url_query_process_response(response, image_title):
     return url
 
 def image_size(image_title):
-    params = query_default_params()
-    image_size_query_add_params(params, image_title)
-    session = anonymous_session('commons.wikimedia.org')
-    response = session.get(**params)
-    return image_size_query_process_response(response, image_title)
+    image = load_image(image_title)
+    return image['image_width'], image['image_height']
 
 def image_size_query_add_params(params, image_title):
     params.setdefault('prop', set()).update(['imageinfo'])
@@ -1034,6 +1862,34 @@ def image_size_query_process_response(response, image_title):
 
     return width, height
 
+def image_thumbnail_query_add_params(params, image_title):
+    params.setdefault('prop', set()).update(['imageinfo'])
+    params.setdefault('iiprop', set()).update(['url', 'mime'])
+    params['iiurlwidth'] = 8000
+    params.setdefault('titles', set()).update(['File:' + image_title])
+
+def image_thumbnail_query_process_response(response, image_title):
+    page = query_response_page(response, 'File:' + image_title)
+    imageinfo = page['imageinfo'][0]
+    if imageinfo.get('thumburl') is None:
+        return None  # the file type has no thumbnails
+
+    return {
+        'url': imageinfo['thumburl'],
+        'width': imageinfo['thumbwidth'],
+        'height': imageinfo['thumbheight'],
+        'mime': imageinfo['mime'],
+    }
+
+def image_revision_query_add_params(params, image_title):
+    params.setdefault('prop', set()).update(['info'])
+    params.setdefault('titles', set()).update(['File:' + image_title])
+
+def image_revision_query_process_response(response, image_title):
+    page = query_response_page(response, 'File:' + image_title)
+    # the file page revision also covers the MediaInfo entity, which lives on the same page
+    return page['lastrevid']
+
 def query_default_params():
     return {'action': 'query', 'formatversion': 2}
 
@@ -1046,6 +1902,63 @@ def query_response_page(response, title):
     pages = response['query']['pages']
     return next(page for page in pages if page['title'] == title)
 
+@app.before_request
+def start_request_timing():
+    flask.g.request_start = time.perf_counter()
+
+@flask.before_render_template.connect_via(app)
+def start_render_span(sender, template, context, **extra):
+    flask.g.setdefault('render_spans', []).append(tracing.Span('render', None, template.name))
+
+@flask.template_rendered.connect_via(app)
+def finish_render_span(sender, template, context, **extra):
+    flask.g.render_spans.pop().finish()
+
+@app.template_global()
+def show_timing():
+    return 'timing' in flask.request.args
+
+@app.template_global()
+def request_spans():
+    return tracing.request_spans()
+
+@app.after_request
+def add_server_timing(response):
+    """Tell the client how long the upstream requests and rendering took.
+
+    For streamed responses, this only includes the spans until the response started."""
+    metrics = tracing.server_timing(tracing.request_spans())
+    if 'request_start' in flask.g:
+        total = 'total;dur=%.1f' % ((time.perf_counter() - flask.g.request_start) * 1000)
+        metrics = total + (', ' + metrics if metrics else '')
+    if metrics:
+        response.headers['Server-Timing'] = metrics
+    return response
+
+tracing.add_listener(metrics.observe_span)
+
+@app.after_request
+def observe_request_metrics(response):
+    if 'request_start' in flask.g:
+        metrics.observe_request(flask.request.endpoint, flask.request.method,
+                                time.perf_counter() - flask.g.request_start)
+    metrics.update_cache_metrics(cache_stats())
+    return response
+
+def cache_stats():
+    """Get the hits, misses and size (if known) of the caches in this process, for the metrics."""
+    stats = {}
+    for name, cache in [('labels', _labels_cache),
+                        ('depicted_properties_labels', _depicted_properties_labels_cache),
+                        ('images', _images_cache),
+                        ('manifests', _manifests_cache),
+                        ('queues', _queues_cache)]:
+        size = cache.currsize if isinstance(cache, caches.MemoryCache) else None
+        stats[name] = (cache.hits, cache.misses, size)
+    format_value_info = format_value.cache_info()
+    stats['formatted_values'] = (format_value_info.hits, format_value_info.misses, format_value_info.currsize)
+    return stats
+
 @app.after_request
 def denyFrame(response):
     """Disallow embedding the tool’s pages in other websites.
@@ -1057,3 +1970,234 @@ def denyFrame(response):
     """
     response.headers['X-Frame-Options'] = 'deny'
     return response
+
+@app.cli.command('generate-manifests')
+@click.argument('input', type=click.File('r'), default='-')
+@click.option('--property-id', default=default_property, help='Image property.')
+@click.option('--language', default='en', help='Language code for labels and metadata.')
+@click.option('--base-url', default='https://wd-image-positions.toolforge.org/', help='URL of the tool, for the manifest IDs.')
+@click.option('--output-dir', type=click.Path(file_okay=False), help='Write one <item ID>.json file per manifest here.')
+@click.option('--output-jsonl', type=click.File('a'), help='Append one {"item_id": …, "manifest": …} line per manifest here.')
+@click.option('--checkpoint', type=click.Path(dir_okay=False), help='File of finished item IDs; these are skipped when resuming.')
+@click.option('--concurrency', default=4, help='Number of batches of 50 items processed in parallel.')
+def generate_manifests(input, property_id, language, base_url, output_dir, output_jsonl, checkpoint, concurrency):
+    """Generate IIIF manifests for the item IDs in INPUT (one per line, default stdin)."""
+    if (output_dir is None) == (output_jsonl is None):
+        raise click.UsageError('Specify exactly one of --output-dir and --output-jsonl.')
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    done = set()
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            done.update(line.strip() for line in f)
+    item_ids = [line.strip() for line in input if line.strip() and line.strip() not in done]
+    batches = [item_ids[i:i + 50] for i in range(0, len(item_ids), 50)]
+    click.echo(f'{len(item_ids)} items to process ({len(done)} already done)', err=True)
+
+    checkpoint_file = open(checkpoint, 'a') if checkpoint is not None else None
+    output_lock = threading.Lock()
+    progress = collections.Counter(items=0, manifests=0, errors=0)
+    start = time.monotonic()
+
+    def process_batch(batch):
+        with app.app_context():
+            flask.g.interface_language_code = language
+            with app.test_request_context(base_url=base_url):
+                items = load_items_and_property(batch, property_id, include_description=True, include_metadata=True)
+                paths = {item['entity_id']: flask.url_for('iiif_manifest_with_property', item_id=item['entity_id'], property_id=property_id)
+                         for item in items}
+            manifests = {}
+            for item in items:
+                if 'image_title' not in item:
+                    continue
+                # full_url() takes the scheme from the proxy’s header
+                with app.test_request_context(paths[item['entity_id']], base_url=base_url,
+                                              headers={'X-Forwarded-Proto': urllib.parse.urlparse(base_url).scheme}):
+                    manifests[item['entity_id']] = build_manifest(item).toJSON(top=True)
+
+        with output_lock:
+            for item_id, manifest in manifests.items():
+                if output_dir is not None:
+                    with open(os.path.join(output_dir, item_id + '.json'), 'w') as f:
+                        json.dump(manifest, f)
+                else:
+                    output_jsonl.write(json.dumps({'item_id': item_id, 'manifest': manifest}) + '\n')
+            if output_jsonl is not None:
+                output_jsonl.flush()
+            if checkpoint_file is not None:
+                checkpoint_file.writelines(item_id + '\n' for item_id in batch)
+                checkpoint_file.flush()
+            progress['items'] += len(batch)
+            progress['manifests'] += len(manifests)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as batch_executor:
+        futures = {batch_executor.submit(process_batch, batch): batch for batch in batches}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                progress['errors'] += len(futures[future])
+                click.echo(f'Error in batch starting with {futures[future][0]}: {e!r}', err=True)
+            elapsed = time.monotonic() - start
+            click.echo(f'{progress["items"]} items, {progress["manifests"]} manifests, {progress["errors"]} errors'
+                       f' ({progress["items"] / elapsed:.1f} items/s)', err=True)
+
+    if checkpoint_file is not None:
+        checkpoint_file.close()
+
+def region_index_store(index_path):
+    index_path = index_path or app.config.get('REGION_INDEX')
+    if index_path is None:
+        raise click.UsageError('Configure REGION_INDEX or specify --index.')
+    return region_index.RegionStore(index_path)
+
+def load_entities_for_region_index(domain, titles):
+    """Load the current depicteds of the entities on the given pages, with one wbgetentities request per 50 pages.
+
+    Returns a list of (entity ID, title, depicteds) tuples for the region index,
+    and the titles of the pages that have no entity (anymore)."""
+    session = anonymous_session(domain)
+    entities = []
+    missing_titles = []
+    for chunk in [titles[i:i + 50] for i in range(0, len(titles), 50)]:
+        if domain == 'www.wikidata.org':
+            params = {'ids': chunk}
+        else:
+            params = {'sites': 'commonswiki', 'titles': chunk}
+        api_response = session.get(action='wbgetentities',
+                                   props=['info', 'claims'],
+                                   **params)
+        found_titles = set()
+        for entity in api_response['entities'].values():
+            if 'missing' in entity:
+                continue
+            title = entity.get('title', entity['id'])
+            found_titles.add(title)
+            entities.append((entity['id'], title, depicted_items(entity)))
+        # deleted pages, redirected items and files without structured data
+        missing_titles.extend(title for title in chunk if title not in found_titles)
+    return entities, missing_titles
+
+@app.cli.group('region-index')
+def region_index_cli():
+    """Build and update the local region index (see REGION_INDEX)."""
+
+region_index_option = click.option('--index', 'index_path', type=click.Path(dir_okay=False),
+                                   help='SQLite file of the index (default: REGION_INDEX).')
+
+def region_index_entities(entities):
+    """Get the (entity ID, title, depicteds) tuples for the region index of some entities of a dump."""
+    return [(entity['id'], entity.get('title', entity['id']), depicted_items(entity))
+            for entity in entities]
+
+@region_index_cli.command('build')
+@region_index_option
+@click.option('--processes', type=int, help='Number of worker processes parsing the dumps (default: number of CPUs).')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+def region_index_build(index_path, processes, paths):
+    """Add the entities of the Wikidata or Commons JSON dumps at PATHS (.json, .json.gz or .json.bz2) to the index."""
+    store = region_index_store(index_path)
+    for path in paths:
+        indexed = store.replace_entities(entity
+                                         for chunk in dumps.process_dump(path, region_index_entities, processes=processes)
+                                         for entity in chunk)
+        click.echo(f'{path}: {indexed} entities with regions', err=True)
+    store.set_meta('built', int(time.time()))
+    counts = store.counts()
+    click.echo(f'{counts["entities"]} entities and {counts["statements"]} statements in the index', err=True)
+
+@region_index_cli.command('update')
+@region_index_option
+@click.argument('input', type=click.File('r'), default='-')
+def region_index_update(index_path, input):
+    """Replay recent changes from INPUT (default stdin) into the index.
+
+    INPUT has one EventStreams recentchange event (JSON) per line.
+    The current data of each changed page is loaded from the API;
+    events older than the last replayed one are skipped,
+    so overlapping replay files can be used."""
+    store = region_index_store(index_path)
+    since = store.get_meta('last_change')
+    pages, latest = region_index.changed_pages((json.loads(line) for line in input if line.strip()),
+                                               since=int(since) if since is not None else None)
+    for domain, titles in pages.items():
+        entities, missing_titles = load_entities_for_region_index(domain, sorted(titles))
+        store.replace_entities(entities)
+        store.delete_entities(titles=missing_titles)
+        click.echo(f'{domain}: {len(titles)} changed pages, {len(missing_titles)} deleted or without entity', err=True)
+    if latest is not None:
+        store.set_meta('last_change', latest)
+
+# upper bounds of the buckets of region sizes in dump statistics, in percent of the image area
+region_area_buckets = [1, 5, 10, 25, 50, 100]
+
+def region_statistics(entities):
+    """Count the depicted statements and their regions in some entities of a dump.
+
+    Sizes are only counted for full and pct regions,
+    since the size of the image is not part of the dump."""
+    counts = collections.Counter()
+    for entity in entities:
+        counts['entities'] += 1
+        if best_value(entity, default_property) is not None:
+            counts['entities_with_image'] += 1
+        depicteds = depicted_items(entity)
+        if depicteds:
+            counts['entities_with_depicteds'] += 1
+        if any('iiif_region' in depicted for depicted in depicteds):
+            counts['entities_with_regions'] += 1
+        for depicted in depicteds:
+            counts['statements', depicted['property_id']] += 1
+            if 'iiif_region' not in depicted:
+                continue
+            counts['statements_with_region', depicted['property_id']] += 1
+            try:
+                region = Region.parse(depicted['iiif_region'])
+            except ValueError:
+                counts['region_kind', 'invalid'] += 1
+                continue
+            counts['region_kind', region.kind] += 1
+            if region.kind != 'pixel':
+                bucket = min(bisect.bisect_left(region_area_buckets, region.area / 100), len(region_area_buckets) - 1)
+                counts['region_area', region_area_buckets[bucket]] += 1
+    return counts
+
+def summarize_region_statistics(counts):
+    """Turn the counts of region_statistics() into a JSON-serializable summary."""
+    properties = {}
+    for property_id in depicted_properties:
+        statements = counts['statements', property_id]
+        with_region = counts['statements_with_region', property_id]
+        properties[property_id] = {
+            'statements': statements,
+            'with_region': with_region,
+            'share_with_region': round(with_region / statements, 4) if statements else None,
+        }
+    return {
+        'entities': counts['entities'],
+        'entities_with_image': counts['entities_with_image'],
+        'entities_with_depicteds': counts['entities_with_depicteds'],
+        'entities_with_regions': counts['entities_with_regions'],
+        'properties': properties,
+        'region_kinds': {kind: counts['region_kind', kind] for kind in ['full', 'pct', 'pixel', 'invalid']},
+        'region_area_percent': {f'<={bound}': counts['region_area', bound] for bound in region_area_buckets},
+    }
+
+@app.cli.command('dump-stats')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', type=click.File('w'), default='-', help='File for the statistics (JSON, default stdout).')
+@click.option('--processes', type=int, help='Number of worker processes parsing the dumps (default: number of CPUs).')
+def dump_stats(paths, output, processes):
+    """Write statistics about the regions in the Wikidata or Commons JSON dumps at PATHS (.json, .json.gz or .json.bz2).
+
+    The statistics of all dumps are added up."""
+    counts = collections.Counter()
+    start = time.monotonic()
+    for path in paths:
+        for chunk_counts in dumps.process_dump(path, region_statistics, processes=processes):
+            counts.update(chunk_counts)
+        elapsed = time.monotonic() - start
+        click.echo(f'{path}: {counts["entities"]} entities so far ({counts["entities"] / elapsed:.1f} entities/s)', err=True)
+    json.dump(summarize_region_statistics(counts), output, indent=2)
+    output.write('\n')
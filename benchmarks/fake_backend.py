@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""A local stand-in for the Wikidata, Commons and SPARQL APIs.
+
+The responses are built from the fixtures in the fixtures/ directory,
+which are modelled on real API responses:
+items Q1–Q999 are paintings with an image (File:Q<n>.jpg, MediaInfo M<n>)
+and a configurable number of depicted statements with regions,
+other entities only have labels.
+Every upstream request is counted, and can be delayed to simulate network latency.
+"""
+
+import collections
+import copy
+import http.server
+import json
+import os
+import re
+import requests.adapters
+import threading
+import time
+import urllib.parse
+
+
+_fixtures_directory = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def _load_fixture(name):
+    with open(os.path.join(_fixtures_directory, name + '.json'), encoding='utf8') as f:
+        return json.load(f)
+
+
+def _substitute(value, replacements):
+    """Replace $PLACEHOLDERS in all strings of a fixture."""
+    if isinstance(value, str):
+        for placeholder, replacement in replacements.items():
+            value = value.replace(placeholder, replacement)
+        return value
+    if isinstance(value, list):
+        return [_substitute(element, replacements) for element in value]
+    if isinstance(value, dict):
+        return {_substitute(key, replacements): _substitute(element, replacements) for key, element in value.items()}
+    return value
+
+
+class FakeBackend:
+    """The fake APIs, served over HTTP on localhost (see mount())."""
+
+    def __init__(self, depicteds=10, sparql_results=100, latency=0.0, sparql_latency=None):
+        self.depicteds = depicteds
+        self.sparql_results = sparql_results
+        self.latency = latency  # in seconds, for each API request
+        self.sparql_latency = latency if sparql_latency is None else sparql_latency
+        self.calls = collections.Counter()  # (domain, action) → number of requests
+        self._calls_lock = threading.Lock()
+        self._item = _load_fixture('item')
+        self._mediainfo = _load_fixture('mediainfo')
+        self._imageinfo = _load_fixture('imageinfo')
+        self._server = None
+
+    def start(self):
+        handler = type('Handler', (_Handler,), {'backend': self})
+        self._server = http.server.ThreadingHTTPServer(('localhost', 0), handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def url(self):
+        return 'http://localhost:%d' % self._server.server_address[1]
+
+    def mount(self, session):
+        """Send all HTTPS requests of a requests.Session to the fake APIs."""
+        session.mount('https://', _RewritingAdapter(self.url))
+
+    def total_calls(self):
+        with self._calls_lock:
+            return sum(self.calls.values())
+
+    def count(self, domain, action):
+        with self._calls_lock:
+            self.calls[(domain, action)] += 1
+
+    def depicted_statements(self, entity_id):
+        return [{
+            'mainsnak': {'snaktype': 'value', 'property': 'P180',
+                         'datavalue': {'value': {'entity-type': 'item', 'id': 'Q%d' % (1000 + i)}, 'type': 'wikibase-entityid'},
+                         'datatype': 'wikibase-item'},
+            'type': 'statement',
+            'id': '%s$%08d-0000-0000-0000-000000000180' % (entity_id, i),
+            'rank': 'normal',
+            'qualifiers': {'P2677': [{
+                'snaktype': 'value', 'property': 'P2677', 'hash': '%040x' % i,
+                'datavalue': {'value': 'pct:%d,%d,10,10' % (i % 10 * 10, i // 10 % 10 * 10), 'type': 'string'},
+            }]},
+        } for i in range(self.depicteds)]
+
+    def entity(self, entity_id, languages):
+        number = int(entity_id[1:]) if entity_id[1:].isdigit() else 0
+        if entity_id.startswith('Q') and 0 < number < 1000:
+            entity = _substitute(copy.deepcopy(self._item), {'$ID': entity_id})
+            if self.depicteds:
+                entity['claims']['P180'] = self.depicted_statements(entity_id)
+            return entity
+        if entity_id.startswith('M') and number:
+            entity = _substitute(copy.deepcopy(self._mediainfo), {'$ID': entity_id, '$TITLE': 'Q%d.jpg' % number})
+            entity['pageid'] = number
+            if self.depicteds:
+                entity['statements']['P180'] = self.depicted_statements(entity_id)
+            return entity
+        return {
+            'type': 'property' if entity_id.startswith('P') else 'item',
+            'id': entity_id,
+            'lastrevid': 1,
+            'labels': {language: {'language': language, 'value': 'label of %s (%s)' % (entity_id, language)}
+                       for language in languages},
+        }
+
+    def api(self, domain, params):
+        action = params.get('action')
+        self.count(domain, action)
+        time.sleep(self.latency)
+        if action == 'wbgetentities':
+            languages = params.get('languages', 'en').split('|')
+            if 'ids' in params:
+                entity_ids = params['ids'].split('|')
+            else:
+                # sites=commonswiki&titles=File:…
+                entity_ids = ['M%d' % self.page_id(title) for title in params['titles'].split('|')]
+            return {'entities': {entity_id: self.entity(entity_id, languages) for entity_id in entity_ids}, 'success': 1}
+        if action == 'query' and params.get('list') in {'categorymembers', 'search'}:
+            # every category and search has the files of items Q1, Q2, …
+            limit = int(params.get('cmlimit', params.get('srlimit', 10)))
+            files = [{'ns': 6, 'title': 'File:Q%d.jpg' % number, 'pageid': number}
+                     for number in range(1, min(self.sparql_results, limit) + 1)]
+            return {'batchcomplete': True, 'query': {params['list']: files}}
+        if action == 'query' and 'pageids' in params:
+            pages = [{'pageid': int(page_id), 'ns': 6, 'title': 'File:Q%s.jpg' % page_id}
+                     for page_id in params['pageids'].split('|')]
+            return {'batchcomplete': True, 'query': {'pages': pages}}
+        if action == 'query':
+            pages = []
+            for title in params.get('titles', '').split('|'):
+                if not title:
+                    continue
+                page = _substitute(copy.deepcopy(self._imageinfo), {
+                    '$TITLE': title[len('File:'):],
+                    '$URLTITLE': urllib.parse.quote(title[len('File:'):].replace(' ', '_')),
+                })
+                page['pageid'] = self.page_id(title)
+                pages.append(page)
+            return {'batchcomplete': True, 'query': {'pages': pages}}
+        if action == 'wbformatvalue':
+            datavalue = json.loads(params['datavalue'])
+            value = datavalue['value']
+            if isinstance(value, dict):
+                value = value.get('id') or value.get('time') or value.get('amount')
+            return {'result': '<a href="https://www.wikidata.org/wiki/%s">%s</a>' % (value, value)}
+        return {'error': {'code': 'badvalue', 'info': 'Unsupported action in the fake backend: %s' % action}}
+
+    def sparql(self, params):
+        """Return items Q1, Q2, … for any query, honoring its LIMIT and OFFSET, as TSV."""
+        self.count('query.wikidata.org', 'sparql')
+        time.sleep(self.sparql_latency)
+        query = params.get('query', '')
+        limit = re.search(r'LIMIT (\d+)', query)
+        offset = re.search(r'OFFSET (\d+)', query)
+        start = 1 + (int(offset.group(1)) if offset else 0)
+        end = self.sparql_results + 1
+        if limit:
+            end = min(end, start + int(limit.group(1)))
+        return '?item\n' + ''.join('<http://www.wikidata.org/entity/Q%d>\n' % number for number in range(start, end))
+
+    @staticmethod
+    def page_id(title):
+        match = re.fullmatch(r'File:Q(\d+)\.jpg', title.replace('_', ' '))
+        return int(match.group(1)) if match else 100_000 + sum(title.encode('utf8')) % 100_000
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # otherwise, keep-alive responses are delayed by ~40 ms
+    backend = None  # set by FakeBackend.start()
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        self.respond(url.path, dict(urllib.parse.parse_qsl(url.query)))
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf8')
+        self.respond(url.path, {**dict(urllib.parse.parse_qsl(url.query)), **dict(urllib.parse.parse_qsl(body))})
+
+    def respond(self, path, params):
+        domain, _, path = path[1:].partition('/')
+        if path == 'sparql':
+            body = self.backend.sparql(params).encode('utf8')
+            content_type = 'text/tab-separated-values'
+        else:
+            body = json.dumps(self.backend.api(domain, params)).encode('utf8')
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _RewritingAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter sending https://domain/path to base_url/domain/path."""
+
+    def __init__(self, base_url):
+        super().__init__(pool_maxsize=32)
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        url = urllib.parse.urlsplit(request.url)
+        request.url = self.base_url + '/' + url.netloc + url.path + ('?' + url.query if url.query else '')
+        return super().send(request, **kwargs)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark the main routes of the tool against the fake backend.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.run --latency 50 --requests 20
+
+For each route, this reports the median and 95th percentile latency
+of sequential requests, the number of upstream API calls per request,
+and the throughput with --concurrency parallel clients.
+"""
+
+import click
+import concurrent.futures
+import json
+import statistics
+import time
+
+import app as wdip
+import caches
+from benchmarks.fake_backend import FakeBackend
+
+
+routes = {
+    'item': '/item/Q1',
+    'file': '/file/Q1.jpg',
+    'manifest': '/iiif/Q1/P18/manifest.json',
+    'annotations': '/iiif/Q1/P18/list/annotations.json',
+    'iiif_region': '/iiif_region/pct:10,20,10,10',
+}
+
+
+def install(backend):
+    """Point the app’s sessions at the fake backend."""
+    original_pooled_requests_session = wdip.pooled_requests_session
+
+    def pooled_requests_session():
+        session = original_pooled_requests_session()
+        backend.mount(session)
+        return session
+
+    wdip.pooled_requests_session = pooled_requests_session
+    wdip._anonymous_sessions.clear()
+    backend.mount(wdip.requests_session)
+
+    # the interface language info would otherwise be loaded from meta.wikimedia.org
+    import toolforge_i18n._language_info
+    toolforge_i18n._language_info._language_info = {
+        'en': {'bcp47': 'en', 'dir': 'ltr', 'autonym': 'English', 'fallbacks': []},
+    }
+    toolforge_i18n._language_info._by_bcp47 = {'en': 'en'}
+
+
+def clear_caches():
+    for name in ['_labels_cache', '_depicted_properties_labels_cache', '_images_cache', '_manifests_cache']:
+        cache = getattr(wdip, name)
+        setattr(wdip, name, caches.MemoryCache(maxsize=cache.maxsize, ttl=60 * 60))
+    wdip.query_service.cache = caches.MemoryCache(maxsize=1000, ttl=60 * 60)
+    wdip.format_value.cache_clear()
+
+
+def get(client, path):
+    response = client.get(path, query_string={'uselang': 'en'})
+    response.get_data()  # consume streamed responses
+    if response.status_code != 200:
+        raise click.ClickException(f'{path} returned {response.status_code}')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def benchmark_route(backend, path, requests, concurrency, cold):
+    client = wdip.app.test_client()
+    if not cold:
+        get(client, path)  # warm up the caches
+
+    durations = []
+    calls_before = backend.total_calls()
+    for _ in range(requests):
+        if cold:
+            clear_caches()
+        start = time.perf_counter()
+        get(client, path)
+        durations.append(time.perf_counter() - start)
+    calls = backend.total_calls() - calls_before
+
+    def client_loop(count):
+        thread_client = wdip.app.test_client()
+        for _ in range(count):
+            get(thread_client, path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        futures = [pool.submit(client_loop, requests // concurrency + (index < requests % concurrency))
+                   for index in range(concurrency)]
+        for future in futures:
+            future.result()
+        wall_time = time.perf_counter() - start
+
+    return {
+        'p50_ms': round(statistics.median(durations) * 1000, 1),
+        'p95_ms': round(percentile(durations, 0.95) * 1000, 1),
+        'upstream_calls_per_request': round(calls / requests, 2),
+        'throughput_rps': round(requests / wall_time, 1),
+    }
+
+
+@click.command()
+@click.option('--requests', default=20, help='Requests per route.')
+@click.option('--concurrency', default=4, help='Parallel clients for the throughput measurement.')
+@click.option('--latency', default=20.0, help='Injected latency of each API request, in milliseconds.')
+@click.option('--sparql-latency', type=float, help='Injected latency of SPARQL queries, in milliseconds (default: --latency).')
+@click.option('--depicteds', default=10, help='Depicted statements (with regions) per item and file.')
+@click.option('--sparql-results', default=100, help='Items returned by SPARQL queries.')
+@click.option('--cold', is_flag=True, help='Clear the caches before every (sequential) request.')
+@click.option('--route', 'selected_routes', multiple=True, type=click.Choice(list(routes)), help='Only benchmark these routes.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the results as JSON, e.g. to compare runs.')
+def main(requests, concurrency, latency, sparql_latency, depicteds, sparql_results, cold, selected_routes, as_json):
+    """Benchmark the main routes of the tool against a fake backend."""
+    backend = FakeBackend(depicteds=depicteds,
+                          sparql_results=sparql_results,
+                          latency=latency / 1000,
+                          sparql_latency=sparql_latency / 1000 if sparql_latency is not None else None).start()
+    install(backend)
+    try:
+        results = {name: benchmark_route(backend, path, requests, concurrency, cold)
+                   for name, path in routes.items()
+                   if not selected_routes or name in selected_routes}
+    finally:
+        backend.stop()
+
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+        return
+    click.echo(f'{"route":<12} {"p50 ms":>8} {"p95 ms":>8} {"calls/req":>10} {"req/s":>8}')
+    for name, result in results.items():
+        click.echo(f'{name:<12} {result["p50_ms"]:>8} {result["p95_ms"]:>8} '
+                   f'{result["upstream_calls_per_request"]:>10} {result["throughput_rps"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+"""Cache backends for data loaded from Wikidata and Commons.
+
+The memory backend keeps the data in the current process,
+so each gunicorn worker has its own copy;
+the file and Redis backends are shared between all workers,
+and store values as JSON (never pickle, since other users
+might be able to write to the directory or server).
+Use make_cache() to get a cache for the configured backend.
+"""
+
+import cachetools
+import hashlib
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.parse
+
+
+class Cache:
+    """Base class for caches, with string keys and JSON-serializable values.
+
+    Subclasses implement _get_many() and set_many(),
+    which should never raise errors if the backend is unavailable
+    (a cache that cannot be reached just behaves as if it were empty).
+    The hits and misses of each cache (in this process) are counted.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get_many(self, keys):
+        """Get the cached values for the given keys, as a dict.
+
+        Keys that are not in the cache are missing from the result."""
+        keys = list(keys)
+        values = self._get_many(keys)
+        with self._stats_lock:
+            self.hits += len(values)
+            self.misses += len(keys) - len(values)
+        return values
+
+    def _get_many(self, keys):
+        raise NotImplementedError
+
+    def set_many(self, mapping):
+        """Cache all the values in the given dict."""
+        raise NotImplementedError
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+
+class MemoryCache(Cache):
+    """Cache in the memory of the current process, with LRU and TTL eviction."""
+
+    def __init__(self, maxsize, ttl):
+        super().__init__()
+        self._cache = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.RLock()
+
+    def _get_many(self, keys):
+        values = {}
+        with self._lock:
+            for key in keys:
+                try:
+                    values[key] = self._cache[key]
+                except KeyError:
+                    pass
+        return values
+
+    def set_many(self, mapping):
+        with self._lock:
+            self._cache.update(mapping)
+
+    @property
+    def currsize(self):
+        return self._cache.currsize
+
+    @property
+    def maxsize(self):
+        return self._cache.maxsize
+
+
+class FileCache(Cache):
+    """Cache in a directory on the local file system, shared between processes.
+
+    Each entry is one JSON file, written atomically,
+    whose modification time is set to its expiry time.
+    Expired entries are removed when they are read;
+    every prune_interval writes, a background thread removes all expired entries
+    and, if there are more than maxsize entries, the ones expiring soonest.
+    """
+
+    prune_interval = 1000
+
+    def __init__(self, namespace, maxsize, ttl, directory):
+        super().__init__()
+        self._directory = os.path.join(directory, namespace)
+        os.makedirs(self._directory, mode=0o700, exist_ok=True)
+        os.chmod(directory, 0o700)
+        os.chmod(self._directory, 0o700)
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._writes = 0
+        self._prune_lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self._directory, hashlib.sha256(key.encode('utf8')).hexdigest() + '.json')
+
+    def _get_many(self, keys):
+        values = {}
+        now = time.time()
+        for key in keys:
+            path = self._path(key)
+            try:
+                if os.stat(path).st_mtime < now:
+                    self._remove(path)
+                    continue
+                with open(path, encoding='utf8') as f:
+                    entry = json.load(f)
+                if entry['key'] == key:  # otherwise, hash collision
+                    values[key] = entry['value']
+            except (OSError, ValueError, TypeError, KeyError):
+                continue
+        return values
+
+    def set_many(self, mapping):
+        expires = time.time() + self._ttl
+        for key, value in mapping.items():
+            f = None
+            try:
+                with tempfile.NamedTemporaryFile('w', encoding='utf8', dir=self._directory, delete=False) as f:
+                    json.dump({'key': key, 'value': value}, f)
+                os.utime(f.name, (expires, expires))
+                os.replace(f.name, self._path(key))
+            except (OSError, TypeError, ValueError):
+                if f is not None:
+                    self._remove(f.name)
+        self._writes += len(mapping)
+        if self._writes >= self.prune_interval:
+            self._writes = 0
+            threading.Thread(target=self.prune, daemon=True).start()
+
+    def prune(self):
+        """Remove all expired entries, and the soonest-expiring ones beyond maxsize."""
+        if not self._prune_lock.acquire(blocking=False):
+            return  # already pruning
+        try:
+            now = time.time()
+            entries = []
+            for entry in os.scandir(self._directory):
+                try:
+                    expires = entry.stat().st_mtime
+                except OSError:
+                    continue
+                if expires < now:
+                    self._remove(entry.path)
+                else:
+                    entries.append((expires, entry.path))
+            if len(entries) > self._maxsize:
+                entries.sort()
+                for _, path in entries[:len(entries) - self._maxsize]:
+                    self._remove(path)
+        finally:
+            self._prune_lock.release()
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class RedisCache(Cache):
+    """Cache in a Redis server (or anything else speaking the Redis protocol).
+
+    This implements just enough of the protocol (RESP) for MGET and SET,
+    with one connection per thread; expiry is left to the server.
+    After a connection error, the server is not contacted again
+    for retry_interval seconds (the cache behaves as if it were empty).
+    """
+
+    retry_interval = 30
+
+    def __init__(self, namespace, ttl, url):
+        super().__init__()
+        url = urllib.parse.urlparse(url)
+        self._address = (url.hostname or 'localhost', url.port or 6379)
+        self._db = int(url.path[1:] or 0)
+        self._prefix = namespace + ':'
+        self._ttl_ms = int(ttl * 1000)
+        self._local = threading.local()
+        self._unavailable_until = 0
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if time.monotonic() < self._unavailable_until:
+                # not an OSError, so that it does not restart the retry interval (see _disconnect())
+                raise _RecentlyUnavailable()
+            sock = socket.create_connection(self._address, timeout=1)
+            connection = sock, sock.makefile('rb')
+            self._local.connection = connection
+            if self._db:
+                self._command(['SELECT', str(self._db)])
+        return connection
+
+    def _disconnect(self):
+        self._unavailable_until = time.monotonic() + self.retry_interval
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            sock, reader = connection
+            reader.close()
+            sock.close()
+
+    def _command(self, *commands):
+        """Send the given commands (pipelined) and return their replies."""
+        sock, reader = self._connection()
+        request = bytearray()
+        for command in commands:
+            request += b'*%d\r\n' % len(command)
+            for arg in command:
+                if isinstance(arg, str):
+                    arg = arg.encode('utf8')
+                request += b'$%d\r\n%s\r\n' % (len(arg), arg)
+        sock.sendall(request)
+        return [self._read_reply(reader) for _ in commands]
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Connection closed by Redis server')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf8')
+        if kind == b'-':
+            raise RedisError(rest.decode('utf8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError('Connection closed by Redis server')
+            return data[:-2]
+        if kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply(reader) for _ in range(length)]
+        raise RedisError('Unknown reply type: %r' % line)
+
+    def _get_many(self, keys):
+        if not keys:
+            return {}
+        try:
+            [replies] = self._command(['MGET', *(self._prefix + key for key in keys)])
+        except _RecentlyUnavailable:
+            return {}
+        except (OSError, ValueError, RedisError):
+            self._disconnect()
+            return {}
+        values = {}
+        for key, reply in zip(keys, replies):
+            if reply is None:
+                continue
+            try:
+                values[key] = json.loads(reply)
+            except ValueError:
+                continue
+        return values
+
+    def set_many(self, mapping):
+        if not mapping:
+            return
+        commands = [['SET', self._prefix + key, json.dumps(value), 'PX', str(self._ttl_ms)]
+                    for key, value in mapping.items()]
+        try:
+            self._command(*commands)
+        except _RecentlyUnavailable:
+            pass
+        except (OSError, ValueError, RedisError):
+            self._disconnect()
+
+
+class RedisError(Exception):
+    pass
+
+
+class _RecentlyUnavailable(Exception):
+    """The Redis server was unavailable less than retry_interval seconds ago."""
+
+
+def make_cache(config, namespace, maxsize, ttl):
+    """Create a cache for the given namespace using the configured backend.
+
+    config is the CACHE section of the app config, for example:
+    {'BACKEND': 'file', 'DIRECTORY': '/tmp/wd-image-positions-cache'}
+    or {'BACKEND': 'redis', 'URL': 'redis://localhost:6379/0'}.
+    maxsize is not used by the Redis backend (configure eviction on the server instead).
+    The file backend defaults to a directory in the user’s home, not a shared temporary directory.
+    """
+    backend = config.get('BACKEND', 'memory')
+    if backend == 'memory':
+        return MemoryCache(maxsize=maxsize, ttl=ttl)
+    if backend == 'file':
+        directory = config.get('DIRECTORY', os.path.join(os.path.expanduser('~'), '.cache', 'wd-image-positions'))
+        return FileCache(namespace, maxsize=maxsize, ttl=ttl, directory=directory)
+    if backend == 'redis':
+        return RedisCache(namespace, ttl=ttl, url=config.get('URL', 'redis://localhost:6379/0'))
+    raise ValueError('Unknown cache backend: %r' % backend)
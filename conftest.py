@@ -0,0 +1,93 @@
+import pytest
+import requests
+
+import app as wdip
+import caches
+import tracing
+from benchmarks.fake_backend import FakeBackend
+
+
+@pytest.fixture
+def language_info(monkeypatch):
+    """Offline stand-in for the language info that toolforge_i18n loads from meta.wikimedia.org."""
+    import toolforge_i18n._language_info
+    monkeypatch.setattr(toolforge_i18n._language_info, '_language_info',
+                        {'en': {'bcp47': 'en', 'dir': 'ltr', 'autonym': 'English', 'fallbacks': []}})
+    monkeypatch.setattr(toolforge_i18n._language_info, '_by_bcp47', {'en': 'en'})
+
+
+@pytest.fixture
+def empty_caches(monkeypatch):
+    """Replace the app’s caches of labels, images and manifests with empty memory caches."""
+    for name in ['_labels_cache', '_depicted_properties_labels_cache', '_images_cache', '_manifests_cache']:
+        monkeypatch.setattr(wdip, name, caches.MemoryCache(maxsize=1000, ttl=60))
+
+
+@pytest.fixture
+def fake_backend(monkeypatch, language_info, empty_caches):
+    """Send all upstream requests of the app to a fake backend (see benchmarks/fake_backend.py), with empty caches.
+
+    The app uses its real (traced) sessions, so the calls can be recorded with UpstreamRecorder.
+    Each API request takes 20 ms, so that requests sent in parallel overlap."""
+    backend = FakeBackend(depicteds=3, sparql_results=10, latency=0.02).start()
+    pooled_requests_session = wdip.pooled_requests_session
+
+    def fake_pooled_requests_session():
+        session = pooled_requests_session()
+        backend.mount(session)
+        return session
+
+    monkeypatch.setattr(wdip, 'pooled_requests_session', fake_pooled_requests_session)
+    monkeypatch.setattr(wdip, '_anonymous_sessions', {})
+    sparql_session = requests.Session()
+    sparql_session.headers.update(wdip.requests_session.headers)
+    backend.mount(sparql_session)
+    monkeypatch.setattr(wdip, 'requests_session', sparql_session)
+    monkeypatch.setattr(wdip.query_service, 'session', sparql_session)
+    monkeypatch.setattr(wdip.query_service, 'cache', caches.MemoryCache(maxsize=1000, ttl=60))
+    wdip.format_value.cache_clear()
+    yield backend
+    wdip.format_value.cache_clear()
+    backend.stop()
+
+
+class UpstreamRecorder:
+    """Records the upstream calls made (in any thread) inside the with block.
+
+    The calls are the tracing spans of API requests and SPARQL queries.
+    round_trips is the number of calls on the critical path,
+    i.e. the longest chain of calls where each one started after the previous one finished;
+    calls sent in parallel count as one round trip."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __enter__(self):
+        tracing.add_listener(self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        tracing.remove_listener(self._record)
+
+    def _record(self, span):
+        if span.kind in {'api', 'sparql'}:
+            self.calls.append(span)
+
+    @property
+    def actions(self):
+        return sorted((span.domain, span.action) for span in self.calls)
+
+    @property
+    def round_trips(self):
+        calls = sorted(self.calls, key=lambda span: span.start)
+        depths = []
+        for index, span in enumerate(calls):
+            depths.append(1 + max((depths[previous] for previous in range(index)
+                                   if calls[previous].start + calls[previous].duration <= span.start),
+                                  default=0))
+        return max(depths, default=0)
+
+
+@pytest.fixture
+def upstream_recorder():
+    return UpstreamRecorder
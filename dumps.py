@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""Reading Wikibase JSON dumps (Wikidata entities or Commons MediaInfo).
+
+The dumps are one big JSON array, with one entity per line,
+so they can be read line by line without loading the whole dump into memory.
+process_dump() parses the entities and processes them in worker processes.
+"""
+
+import bz2
+import collections
+import gzip
+import json
+import multiprocessing
+import os
+
+
+def open_dump(path):
+    """Open a dump for reading as text, decompressing .gz and .bz2 files."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf8')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf8')
+    return open(path, encoding='utf8')
+
+
+def parse_line(line):
+    """Parse one line of a dump into an entity, or None for the lines of the surrounding array."""
+    line = line.strip().rstrip(',')
+    if line in {'', '[', ']'}:
+        return None
+    return json.loads(line)
+
+
+def iter_entities(lines):
+    """Get the entities of the lines of a dump, one by one."""
+    for line in lines:
+        entity = parse_line(line)
+        if entity is not None:
+            yield entity
+
+
+def _chunks(lines, chunk_size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _process_chunk(function, lines):
+    return function(list(iter_entities(lines)))
+
+
+def process_dump(path, function, processes=None, chunk_size=1000):
+    """Call function with chunks of the entities of the dump at path, and yield its results in order.
+
+    The dump is decompressed in this process, while the lines are parsed
+    and function is called in a pool of worker processes,
+    so function must be a module-level function (to be pickled).
+    The workers are spawned rather than forked, since forking a process
+    with threads (e.g. the app’s executor) may deadlock.
+    Only a few chunks per worker are pending at any time,
+    so memory use does not depend on the size of the dump."""
+    processes = processes or os.cpu_count() or 1
+    with multiprocessing.get_context('spawn').Pool(processes) as pool, open_dump(path) as f:
+        pending = collections.deque()
+        for lines in _chunks(f, chunk_size):
+            pending.append(pool.apply_async(_process_chunk, (function, lines)))
+            if len(pending) > 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
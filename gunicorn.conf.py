@@ -0,0 +1,22 @@
+# gunicorn reads this file automatically when started in this directory (see Procfile)
+
+import os
+import tempfile
+
+# share the Prometheus metrics between the workers (see metrics.py);
+# set here, in the master process, so that all workers inherit it
+if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='wd-image-positions-metrics-')
+
+
+def on_starting(server):
+    # remove metrics left over from a previous run using the same directory
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    for file_name in os.listdir(directory):
+        os.remove(os.path.join(directory, file_name))
+
+
+def child_exit(server, worker):
+    import prometheus_client.multiprocess
+    prometheus_client.multiprocess.mark_process_dead(worker.pid)
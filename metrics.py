@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""Prometheus metrics of the tool.
+
+With several gunicorn workers, each worker only sees its own requests,
+so the metrics are shared through files in the PROMETHEUS_MULTIPROC_DIR directory
+(set up by gunicorn.conf.py) and aggregated by the worker that serves /metrics.
+Without that environment variable (e.g. with flask run), the metrics are per process.
+"""
+
+import os
+import prometheus_client
+import prometheus_client.multiprocess
+import threading
+
+
+request_duration = prometheus_client.Histogram(
+    'wdip_request_duration_seconds',
+    'Time spent handling requests, until the response starts (streamed responses may take longer).',
+    ['endpoint', 'method'],
+)
+upstream_requests = prometheus_client.Counter(
+    'wdip_upstream_requests',
+    'Requests to upstream APIs (kind is api or sparql).',
+    ['kind', 'domain', 'action'],
+)
+upstream_request_duration = prometheus_client.Histogram(
+    'wdip_upstream_request_duration_seconds',
+    'Time spent waiting for upstream APIs.',
+    ['kind', 'domain', 'action'],
+)
+upstream_errors = prometheus_client.Counter(
+    'wdip_upstream_api_errors',
+    'MediaWiki API errors (mwapi.errors.APIError) returned by upstream APIs.',
+    ['domain', 'code'],
+)
+cache_hits = prometheus_client.Counter(
+    'wdip_cache_hits',
+    'Cache hits (the hit ratio is hits / (hits + misses)).',
+    ['cache'],
+)
+cache_misses = prometheus_client.Counter(
+    'wdip_cache_misses',
+    'Cache misses.',
+    ['cache'],
+)
+cache_size = prometheus_client.Gauge(
+    'wdip_cache_size',
+    'Number of entries in in-memory caches, summed over all live workers.',
+    ['cache'],
+    multiprocess_mode='livesum',
+)
+
+# hits and misses already counted, per cache (counters can only be incremented)
+_cache_stats_seen = {}
+_cache_stats_lock = threading.Lock()
+
+
+def observe_span(span):
+    """Count a span recorded by the tracing module (see tracing.add_listener)."""
+    if span.kind not in {'api', 'sparql'}:
+        return
+    labels = (span.kind, span.domain or '', span.action or '')
+    upstream_requests.labels(*labels).inc()
+    upstream_request_duration.labels(*labels).observe(span.duration)
+    if span.error:
+        upstream_errors.labels(span.domain or '', span.error).inc()
+
+
+def observe_request(endpoint, method, duration):
+    request_duration.labels(endpoint or '', method).observe(duration)
+
+
+def update_cache_metrics(cache_stats):
+    """Update the cache metrics from a dict of {name: (hits, misses, size or None)}.
+
+    hits and misses are totals since the process started."""
+    with _cache_stats_lock:
+        for name, (hits, misses, size) in cache_stats.items():
+            seen_hits, seen_misses = _cache_stats_seen.get(name, (0, 0))
+            if hits > seen_hits:
+                cache_hits.labels(name).inc(hits - seen_hits)
+            if misses > seen_misses:
+                cache_misses.labels(name).inc(misses - seen_misses)
+            _cache_stats_seen[name] = (max(hits, seen_hits), max(misses, seen_misses))
+            if size is not None:
+                cache_size.labels(name).set(size)
+
+
+def exposition():
+    """Get the metrics of all workers in the text exposition format, and its content type."""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        prometheus_client.multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""A local index of all depicted statements with a region (P2677 qualifier).
+
+The index is an SQLite database, built from Wikidata and Commons JSON dumps
+(flask region-index build) and kept up to date by replaying recent changes
+(flask region-index update), so that the entities with a certain region
+can be looked up without a query to the query service.
+Only entities with at least one region are stored.
+"""
+
+import pathlib
+import sqlite3
+import threading
+
+import tracing
+
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS statements (
+  statement_id TEXT PRIMARY KEY,
+  entity_id TEXT NOT NULL,
+  property_id TEXT NOT NULL,
+  depicted_id TEXT,  -- NULL for somevalue and novalue statements
+  iiif_region TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS statements_region ON statements (iiif_region, entity_id);
+CREATE INDEX IF NOT EXISTS statements_entity ON statements (entity_id);
+CREATE TABLE IF NOT EXISTS entities (
+  entity_id TEXT PRIMARY KEY,
+  title TEXT NOT NULL  -- e.g. File:… for MediaInfo, used to handle deletions
+);
+CREATE INDEX IF NOT EXISTS entities_title ON entities (title);
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+'''
+
+
+class RegionStore:
+    """The index in the SQLite database at the given path.
+
+    A read-only store (as used by the web service) never creates the database,
+    and behaves as if it were empty while the database cannot be read."""
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self._local = threading.local()  # one connection per thread
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self.readonly:
+                connection = sqlite3.connect(pathlib.Path(self.path).absolute().as_uri() + '?mode=ro', uri=True)
+            else:
+                connection = sqlite3.connect(self.path)
+                connection.execute('PRAGMA journal_mode = WAL')  # readers are not blocked by updates
+                connection.execute('PRAGMA synchronous = NORMAL')
+                connection.executescript(_schema)
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def get_meta(self, key, default=None):
+        try:
+            row = self._connection().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error:
+            if not self.readonly:
+                raise
+            return default
+        return row[0] if row is not None else default
+
+    def set_meta(self, key, value):
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def entities_with_region(self, iiif_region, entity_type_prefix, limit, offset=0):
+        """Get the IDs of entities (e.g. prefix Q for items) with the given region, ordered by ID.
+
+        Returns None if the index has not been built or cannot be read."""
+        with tracing.span('index', None, 'region') as span:
+            try:
+                if self.get_meta('built') is None:
+                    return None
+                rows = self._connection().execute('''
+                  SELECT DISTINCT entity_id FROM statements
+                  WHERE iiif_region = ? AND entity_id LIKE ?
+                  ORDER BY entity_id
+                  LIMIT ? OFFSET ?
+                ''', (iiif_region, entity_type_prefix + '%', -1 if limit is None else limit, offset)).fetchall()
+            except sqlite3.Error as e:
+                if not self.readonly:
+                    raise
+                span.error = type(e).__name__
+                return None
+            span.size = len(rows)
+        return [row[0] for row in rows]
+
+    def replace_entities(self, entities, batch_size=10_000):
+        """Replace the indexed statements of the given entities.
+
+        entities is an iterable of (entity ID, title, depicteds) tuples,
+        where depicteds is the result of app.depicted_items();
+        it is consumed in batches, each committed in one transaction.
+        Returns the number of entities with regions."""
+        connection = self._connection()
+        indexed = 0
+        batch = []
+        for entity in entities:
+            batch.append(entity)
+            if len(batch) >= batch_size:
+                indexed += self._replace_batch(connection, batch)
+                batch = []
+        if batch:
+            indexed += self._replace_batch(connection, batch)
+        return indexed
+
+    def _replace_batch(self, connection, batch):
+        indexed = 0
+        with connection:
+            for entity_id, title, depicteds in batch:
+                connection.execute('DELETE FROM statements WHERE entity_id = ?', (entity_id,))
+                rows = [(depicted['statement_id'], entity_id, depicted['property_id'], depicted.get('item_id'), depicted['iiif_region'])
+                        for depicted in depicteds
+                        if 'iiif_region' in depicted]
+                if rows:
+                    connection.executemany('INSERT OR REPLACE INTO statements VALUES (?, ?, ?, ?, ?)', rows)
+                    connection.execute('INSERT OR REPLACE INTO entities VALUES (?, ?)', (entity_id, title))
+                    indexed += 1
+                else:
+                    connection.execute('DELETE FROM entities WHERE entity_id = ?', (entity_id,))
+        return indexed
+
+    def delete_entities(self, entity_ids=(), titles=()):
+        """Remove entities from the index, e.g. because they were deleted."""
+        with self._connection() as connection:
+            entity_ids = list(entity_ids)
+            for title in titles:
+                entity_ids.extend(row[0] for row in connection.execute('SELECT entity_id FROM entities WHERE title = ?', (title,)))
+            for entity_id in entity_ids:
+                connection.execute('DELETE FROM statements WHERE entity_id = ?', (entity_id,))
+                connection.execute('DELETE FROM entities WHERE entity_id = ?', (entity_id,))
+
+    def counts(self):
+        """Get the number of indexed entities and statements."""
+        connection = self._connection()
+        return {
+            'entities': connection.execute('SELECT COUNT(*) FROM entities').fetchone()[0],
+            'statements': connection.execute('SELECT COUNT(*) FROM statements').fetchone()[0],
+        }
+
+
+# the pages whose entities can have depicted statements, per wiki: (domain, namespace)
+indexed_wikis = {
+    'wikidatawiki': ('www.wikidata.org', 0),
+    'commonswiki': ('commons.wikimedia.org', 6),
+}
+
+
+def changed_pages(events, since=None):
+    """Get the pages changed by recent change events (in the EventStreams recentchange format).
+
+    Events before the since timestamp (in seconds) are skipped.
+    Returns the titles of the changed pages (including deleted and moved ones)
+    as a dict from domain to set of titles, and the latest timestamp of the events."""
+    pages = {domain: set() for domain, namespace in indexed_wikis.values()}
+    latest = since
+    for event in events:
+        if event.get('wiki') not in indexed_wikis:
+            continue
+        if since is not None and event['timestamp'] < since:
+            continue
+        latest = max(latest or 0, event['timestamp'])
+        domain, namespace = indexed_wikis[event['wiki']]
+        if event.get('namespace') == namespace:
+            pages[domain].add(event['title'])
+        log_params = event.get('log_params')
+        if event.get('log_type') == 'move' and isinstance(log_params, dict) and 'target' in log_params:
+            pages[domain].add(log_params['target'])
+    return pages, latest
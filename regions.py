@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+"""Parsing and geometry of IIIF image regions.
+
+See https://iiif.io/api/image/2.0/#region for the syntax:
+a region is either "full", "pct:x,y,w,h" (percentages of the image size)
+or "x,y,w,h" (pixels of the full-size image).
+"""
+
+import functools
+import math
+import re
+
+
+_number = r'(\d+(?:\.\d+)?|\.\d+)'
+_pct_re = re.compile(r'pct:' + ','.join([_number] * 4))
+_pixel_re = re.compile(','.join([r'(\d+)'] * 4))
+
+
+class Region:
+    """A parsed IIIF image region.
+
+    kind is 'full', 'pct' or 'pixel';
+    x, y, w, h are floats for pct regions and ints for pixel regions
+    (for full regions, they are 0, 0, 100, 100, i.e. the same as pct:0,0,100,100).
+    Regions are immutable and can be compared and hashed.
+    """
+
+    __slots__ = ('kind', 'x', 'y', 'w', 'h')
+
+    def __init__(self, kind, x, y, w, h):
+        if kind not in {'full', 'pct', 'pixel'}:
+            raise ValueError('Unknown region kind: %r' % kind)
+        if w <= 0 or h <= 0:
+            raise ValueError('Region must not be empty')
+        object.__setattr__(self, 'kind', kind)
+        object.__setattr__(self, 'x', x)
+        object.__setattr__(self, 'y', y)
+        object.__setattr__(self, 'w', w)
+        object.__setattr__(self, 'h', h)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Region is immutable')
+
+    @classmethod
+    def full(cls):
+        return cls('full', 0.0, 0.0, 100.0, 100.0)
+
+    @classmethod
+    def parse(cls, string):
+        """Parse a region string, raising ValueError if it is invalid."""
+        return _parse(string)
+
+    def __str__(self):
+        """The normalized form of the region, e.g. pct:10,20.5,30,40."""
+        if self.kind == 'full':
+            return 'full'
+        values = ','.join(_format_number(value) for value in (self.x, self.y, self.w, self.h))
+        if self.kind == 'pct':
+            return 'pct:' + values
+        return values
+
+    def __repr__(self):
+        return 'Region.parse(%r)' % str(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, Region):
+            return NotImplemented
+        return self._tuple() == other._tuple()
+
+    def __hash__(self):
+        return hash(self._tuple())
+
+    def _tuple(self):
+        return (self.kind, self.x, self.y, self.w, self.h)
+
+    @property
+    def area(self):
+        return self.w * self.h
+
+    def to_pct(self, width, height):
+        """Convert the region to a pct region, given the size of the full image."""
+        if self.kind != 'pixel':
+            return self
+        return Region('pct',
+                      self.x * 100 / width, self.y * 100 / height,
+                      self.w * 100 / width, self.h * 100 / height)
+
+    def to_pixels(self, width, height):
+        """Convert the region to a pixel region, given the size of the (full) image.
+
+        Pixel regions are assumed to already refer to an image of that size."""
+        if self.kind == 'pixel':
+            return self
+        return Region('pixel',
+                      int(self.x * width / 100), int(self.y * height / 100),
+                      max(int(self.w * width / 100), 1), max(int(self.h * height / 100), 1))
+
+    def z_index(self):
+        """A CSS z-index that stacks smaller regions above larger ones."""
+        if self.kind == 'full':
+            return None
+        if self.kind == 'pct':
+            return int(1_000_000 / self.area)
+        return int(1_000_000_000 / self.area)
+
+    def style(self):
+        """CSS to position an element over the region of an image."""
+        if self.kind == 'full':
+            return 'left: 0px; top: 0px; width: 100%; height: 100%;'
+        unit = '%' if self.kind == 'pct' else 'px'
+        left, top, width, height = (_format_number(value) + unit for value in (self.x, self.y, self.w, self.h))
+        return 'left: %s; top: %s; width: %s; height: %s; z-index: %s;' % (left, top, width, height, self.z_index())
+
+
+@functools.lru_cache(maxsize=10_000)
+def _parse(string):
+    # cached, since the same regions are parsed again and again when rendering
+    if string == 'full':
+        return Region.full()
+    match = _pct_re.fullmatch(string)
+    if match:
+        return Region('pct', *(float(group) for group in match.groups()))
+    match = _pixel_re.fullmatch(string)
+    if match:
+        return Region('pixel', *(int(group) for group in match.groups()))
+    raise ValueError('Invalid IIIF region: %r' % string)
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        value = round(value, 6)
+        if value.is_integer():
+            return str(int(value))
+    return str(value)
+
+
+def normalize(string):
+    """Parse a region string and return its normalized form, raising ValueError if it is invalid."""
+    return str(Region.parse(string))
+
+
+def parse_point(string, image_size):
+    """Parse a point, either "x,y" in pixels or "pct:x,y", into pct coordinates.
+
+    Raises ValueError if the point is invalid."""
+    if string.startswith('pct:'):
+        match = re.fullmatch(_number + ',' + _number, string[len('pct:'):])
+        if match:
+            return tuple(float(group) for group in match.groups())
+    else:
+        match = re.fullmatch(r'(\d+),(\d+)', string)
+        if match:
+            width, height = image_size
+            x, y = (int(group) for group in match.groups())
+            return (x * 100 / width, y * 100 / height)
+    raise ValueError('Invalid point: %r' % string)
+
+
+def depicted_regions(depicteds, skip_invalid=False):
+    """Parse the regions of a list of depicteds (see app.depicted_items).
+
+    Returns a list with one Region (or None, for depicteds without region) per depicted.
+    Invalid regions raise ValueError, or become None if skip_invalid is true."""
+    regions = []
+    for depicted in depicteds:
+        region = None
+        if depicted.get('iiif_region'):
+            try:
+                region = Region.parse(depicted['iiif_region'])
+            except ValueError:
+                if not skip_invalid:
+                    raise
+        regions.append(region)
+    return regions
+
+
+def regions_to_pixels(regions, image_size, target_size=None):
+    """Convert a list of regions (or Nones) to pixel regions on an image of target_size.
+
+    image_size is the (width, height) of the full-size image,
+    which pixel regions refer to; target_size, e.g. the size of a thumbnail,
+    defaults to the image size. None entries are kept as they are."""
+    image_width, image_height = image_size
+    target_width, target_height = target_size or image_size
+    same_size = (image_width, image_height) == (target_width, target_height)
+    pixels = []
+    for region in regions:
+        if region is None:
+            pixels.append(None)
+            continue
+        if region.kind == 'pixel' and not same_size:
+            region = region.to_pct(image_width, image_height)
+        pixels.append(region.to_pixels(target_width, target_height))
+    return pixels
+
+
+class RegionIndex:
+    """A static R-tree over the regions of one image, for hit-testing and overlap queries.
+
+    The tree is bulk-loaded with Sort-Tile-Recursive packing,
+    so queries take O(log n + k) time for k results.
+    All regions are indexed in pct coordinates (pixel regions are converted
+    using the image size), and results are sorted by area, smallest first
+    (i.e. the region drawn on top comes first, as with z_index()).
+    """
+
+    __slots__ = ('_root', '_values')
+
+    node_capacity = 16
+
+    def __init__(self, regions, values, image_size):
+        """Index the given regions (None entries are skipped), associated with the given values."""
+        width, height = image_size
+        self._values = []
+        entries = []
+        for region, value in zip(regions, values):
+            if region is None:
+                continue
+            region = region.to_pct(width, height)
+            entries.append(((region.x, region.y, region.x + region.w, region.y + region.h), len(self._values)))
+            self._values.append(value)
+        self._root = self._pack(entries) if entries else None
+
+    def __len__(self):
+        return len(self._values)
+
+    @classmethod
+    def _pack(cls, entries):
+        """Pack (box, index) entries into nodes, level by level, and return the root.
+
+        A node is a (box, leaf, children) tuple,
+        where the children are (box, index) entries for leaves and nodes otherwise."""
+        leaf = True
+        while True:
+            nodes = []
+            slab_count = math.ceil(math.sqrt(math.ceil(len(entries) / cls.node_capacity)))
+            slab_size = slab_count * cls.node_capacity
+            entries = sorted(entries, key=lambda entry: entry[0][0] + entry[0][2])
+            for slab_start in range(0, len(entries), slab_size):
+                slab = sorted(entries[slab_start:slab_start + slab_size], key=lambda entry: entry[0][1] + entry[0][3])
+                for node_start in range(0, len(slab), cls.node_capacity):
+                    children = slab[node_start:node_start + cls.node_capacity]
+                    nodes.append((_bounding_box(box for box, _ in children), leaf, children))
+            if len(nodes) == 1:
+                return nodes[0]
+            entries = [(node[0], node) for node in nodes]
+            leaf = False
+
+    def _search(self, x0, y0, x1, y1, strict):
+        """Find the (box, index) entries whose boxes intersect the given box.
+
+        If strict is true, the intersection must have a non-empty area,
+        otherwise touching boxes (or a box of size 0, i.e. a point, on an edge) also count."""
+        if strict:
+            def intersects(box):
+                return box[0] < x1 and x0 < box[2] and box[1] < y1 and y0 < box[3]
+        else:
+            def intersects(box):
+                return box[0] <= x1 and x0 <= box[2] and box[1] <= y1 and y0 <= box[3]
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            box, leaf, children = stack.pop()
+            if not intersects(box):
+                continue
+            if leaf:
+                found.extend(entry for entry in children if intersects(entry[0]))
+            else:
+                stack.extend(child for _, child in children)
+        return found
+
+    def _sorted_values(self, entries):
+        entries = sorted(entries, key=lambda entry: ((entry[0][2] - entry[0][0]) * (entry[0][3] - entry[0][1]), entry[1]))
+        return [self._values[index] for _, index in entries]
+
+    def containing(self, x, y):
+        """The values of all regions containing the point (x, y), given in pct coordinates."""
+        return self._sorted_values(self._search(x, y, x, y, strict=False))
+
+    def overlapping(self, region, image_size):
+        """The values of all regions overlapping the given region (with a non-empty intersection)."""
+        region = region.to_pct(*image_size)
+        return self._sorted_values(self._search(region.x, region.y, region.x + region.w, region.y + region.h, strict=True))
+
+    def duplicates(self, tolerance=0.5):
+        """Pairs of values whose regions are the same, up to tolerance (in pct) on each edge.
+
+        Pairs are in the order in which the values were given to the index."""
+        pairs = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            _, leaf, children = stack.pop()
+            if not leaf:
+                stack.extend(child for _, child in children)
+                continue
+            for box, index in children:
+                for other_box, other_index in self._search(box[0] - tolerance, box[1] - tolerance,
+                                                           box[2] + tolerance, box[3] + tolerance,
+                                                           strict=False):
+                    if other_index > index and all(abs(a - b) <= tolerance for a, b in zip(box, other_box)):
+                        pairs.append((index, other_index))
+        return [(self._values[index], self._values[other_index]) for index, other_index in sorted(pairs)]
+
+
+def _bounding_box(boxes):
+    x0s, y0s, x1s, y1s = zip(*boxes)
+    return (min(x0s), min(y0s), max(x1s), max(y1s))
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""Cached, paginated and streamed SPARQL SELECT queries.
+
+Results are requested as tab-separated values and parsed line by line
+while they are downloaded, so that large result sets are never held
+in memory as one big JSON document, and so that a query which runs
+into the timeout still returns the rows received until then.
+"""
+
+import re
+import requests
+import time
+
+import tracing
+
+
+class Result:
+    """The rows of a SELECT query, as dicts from variable name (without ?) to value.
+
+    IRIs are returned without the angle brackets and literals without quotes,
+    language tag or datatype. If partial is true, the query ran into the timeout
+    and there may be more rows."""
+
+    __slots__ = ('rows', 'partial')
+
+    def __init__(self, rows, partial=False):
+        self.rows = rows
+        self.partial = partial
+
+
+class SparqlEndpoint:
+    """A SPARQL endpoint with a result cache (see caches.make_cache)."""
+
+    def __init__(self, url, session, cache, timeout=30):
+        self.url = url
+        self.session = session
+        self.cache = cache
+        self.timeout = timeout  # in seconds, for the whole query including the download
+        self.domain = url.split('://', 1)[-1].split('/', 1)[0]
+
+    def select(self, query, limit=None, offset=0):
+        """Run a SELECT query, optionally adding LIMIT and OFFSET, and return a Result.
+
+        Complete results are cached, keyed by the normalized query text;
+        partial results are not cached."""
+        query = normalize_query(query)
+        if limit is not None:
+            query += ' LIMIT %d' % limit
+        if offset:
+            query += ' OFFSET %d' % offset
+        rows = self.cache.get(query)
+        if rows is not None:
+            return Result(rows)
+        result = self._run(query)
+        if not result.partial:
+            self.cache.set(query, result.rows)
+        return result
+
+    def _run(self, query):
+        deadline = time.monotonic() + self.timeout
+        rows = []
+        partial = False
+        with tracing.span('sparql', self.domain, 'sparql') as span:
+            span.size = 0
+            try:
+                with self.session.get(self.url,
+                                      params={'query': query},
+                                      headers={'Accept': 'text/tab-separated-values'},
+                                      timeout=(5, self.timeout),
+                                      stream=True) as response:
+                    response.raise_for_status()
+                    lines = response.iter_lines()
+                    variables = [variable[1:] for variable in next(lines, b'').decode('utf8').split('\t')]
+                    for line in lines:
+                        span.size += len(line) + 1
+                        rows.append(dict(zip(variables, (parse_term(term) for term in line.decode('utf8').split('\t')))))
+                        if time.monotonic() > deadline:
+                            partial = True
+                            break
+            except (requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError):
+                partial = True
+            if partial:
+                span.error = 'timeout'
+        return Result(rows, partial)
+
+
+def normalize_query(query):
+    """Normalize the whitespace of a query, so that equivalent queries share a cache entry.
+
+    Whitespace inside string literals and IRIs is kept."""
+    parts = re.split(r'("(?:[^"\\]|\\.)*"|<[^<>\s]*>)', query)
+    # odd parts are literals or IRIs
+    return ''.join(part if index % 2 else re.sub(r'\s+', ' ', part)
+                   for index, part in enumerate(parts)).strip()
+
+
+_escapes = {'\\t': '\t', '\\n': '\n', '\\r': '\r', '\\"': '"', '\\\\': '\\'}
+
+
+def parse_term(term):
+    """Parse an RDF term in the SPARQL TSV results format into a plain string."""
+    if term.startswith('<') and term.endswith('>'):
+        return term[1:-1]
+    if term.startswith('"'):
+        end = term.rindex('"')
+        return re.sub(r'\\[tnr"\\]', lambda match: _escapes[match.group(0)], term[1:end])
+    return term  # number, boolean, blank node or empty (unbound)
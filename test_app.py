@@ -1,6 +1,15 @@
+import bz2
+import concurrent.futures
+import gzip
+import http.server
+import json
+import mwapi
 import pytest
+import threading
 
 import app as wdip
+import caches
+import region_index
 
 
 @pytest.mark.parametrize('input, expected', [
@@ -50,3 +59,640 @@ def test_parse_image_title_input_question_mark(input):
     expected = 'CSD_Berlin_2022_-_Lucas_Werkmeister_-_49_-_Do_You_Think_You’re_More_Tired_Of_The_War_Than_We_Are?.jpg'
     actual = wdip.parse_image_title_input(input)
     assert expected == actual
+
+
+class FakeWikiSession:
+    """Fake mwapi.Session that records requests and serves any entity or file.
+
+    wbgetentities returns entities with labels (“label of Q1”, or the given labels)
+    and an image (Q1.jpg), plus depicteds statements for the given item IDs;
+    entities of files (sites=commonswiki) are found by title, e.g. File:M1.jpg is M1.
+    wbformatvalue “formats” item values as their ID,
+    and imageinfo queries return a 100×100 image (optionally without thumbnails)."""
+
+    def __init__(self, item_ids=(), depicteds=0, thumbnails=True, labels=None):
+        self.item_ids = item_ids
+        self.depicteds = depicteds
+        self.thumbnails = thumbnails
+        self.labels = labels
+        self.requests = []
+
+    def get(self, **params):
+        self.requests.append(params)
+        if params['action'] == 'wbformatvalue':
+            return {'result': json.loads(params['datavalue'])['value']['id']}
+        if params['action'] == 'wbgetentities':
+            entities = {}
+            if 'ids' in params:
+                entity_ids = params['ids']
+            else:
+                # sites=commonswiki&titles=File:M1.jpg
+                entity_ids = [title[len('File:'):].rsplit('.', 1)[0] for title in params['titles']]
+            for item_id in entity_ids:
+                entities[item_id] = {
+                    'lastrevid': 1,
+                    'labels': self.entity_labels(item_id),
+                    'claims': {'P18': [{
+                        'mainsnak': {'snaktype': 'value', 'datavalue': {'type': 'string', 'value': item_id + '.jpg'}},
+                        'rank': 'normal',
+                    }]},
+                }
+                if item_id in self.item_ids and self.depicteds:
+                    entities[item_id]['claims']['P180'] = [{
+                        'id': '%s$%d' % (item_id, i),
+                        'mainsnak': {'snaktype': 'value', 'datavalue': {'type': 'wikibase-entityid', 'value': {'id': 'Q%d' % (1000 + i)}}},
+                        'qualifiers': {'P2677': [{'snaktype': 'value', 'datavalue': {'value': 'pct:10,20,50,50'}, 'hash': str(i)}]},
+                        'rank': 'normal',
+                    } for i in range(self.depicteds)]
+            return {'entities': entities}
+        assert params['action'] == 'query'
+        pages = []
+        for title in params['titles']:
+            imageinfo = {
+                'extmetadata': {},
+                'url': 'https://upload.wikimedia.org/' + title,
+                'width': 100,
+                'height': 100,
+                'mime': 'image/jpeg',
+            }
+            if self.thumbnails:
+                imageinfo.update(thumburl='https://upload.wikimedia.org/' + title, thumbwidth=100, thumbheight=100)
+            pages.append({
+                'pageid': 1,
+                'title': title,
+                'lastrevid': 1,
+                'imageinfo': [imageinfo],
+            })
+        return {'query': {'pages': pages}}
+
+    def entity_labels(self, entity_id):
+        if self.labels is None:
+            return {'en': {'language': 'en', 'value': 'label of ' + entity_id}}
+        if entity_id in self.labels:
+            return {'en': {'language': 'en', 'value': self.labels[entity_id]}}
+        return {}
+
+
+@pytest.fixture
+def wiki_session(monkeypatch, empty_caches):
+    """Serve the app’s anonymous requests from a FakeWikiSession, with empty caches.
+
+    Call the fixture with the FakeWikiSession arguments to get the session."""
+    def make_wiki_session(*args, **kwargs):
+        session = FakeWikiSession(*args, **kwargs)
+        monkeypatch.setattr(wdip, 'anonymous_session', lambda domain: session)
+        return session
+    return make_wiki_session
+
+
+def test_load_labels_cached(wiki_session):
+    session = wiki_session(labels={'Q1': 'universe'})
+    with wdip.app.test_request_context():
+        wdip.flask.g.interface_language_code = 'en'
+        expected = {
+            'Q1': {'language': 'en', 'value': 'universe'},
+            'Q2': {'language': 'zxx', 'value': 'Q2'},
+        }
+        assert wdip.load_labels(['Q1', 'Q2']) == expected
+        assert wdip.load_labels(['Q2', 'Q1']) == expected
+    assert len(session.requests) == 1
+
+
+def test_health_caches():
+    with wdip.app.test_client() as client:
+        response = client.get('/healthz/caches?uselang=en')
+    assert {'hits', 'misses'} <= response.get_json()['labels'].keys()
+
+
+def test_entity_metadata(wiki_session):
+    session = wiki_session()
+    wdip.format_value.cache.clear()
+
+    def statement(item_id):
+        return {
+            'mainsnak': {'snaktype': 'value', 'datavalue': {'type': 'wikibase-entityid', 'value': {'id': item_id}}},
+            'rank': 'normal',
+        }
+    entity_data = {'claims': {
+        'P170': [statement('Q%d' % i) for i in range(1, 21)],
+        'P186': [statement('Q1'), statement('Q2')],
+    }}
+    expected = {
+        'P170': ['Q%d' % i for i in range(1, 21)],
+        'P186': ['Q1', 'Q2'],
+    }
+    with wdip.app.test_request_context():
+        wdip.flask.g.interface_language_code = 'en'
+        assert wdip.entity_metadata(entity_data) == expected
+        assert wdip.entity_metadata(entity_data) == expected
+    # formatted once per (value, property, language), not again for the second call
+    assert len(session.requests) == 22
+
+
+def test_load_image_single_query(wiki_session):
+    session = wiki_session()
+    with wdip.app.test_request_context():
+        wdip.flask.g.interface_language_code = 'en'
+        image = wdip.load_image('Example.jpg')
+        assert image['image_thumbnail'] == {
+            'url': 'https://upload.wikimedia.org/File:Example.jpg',
+            'width': 100,
+            'height': 100,
+            'mime': 'image/jpeg',
+        }
+        assert wdip.image_attribution('Example.jpg') is None
+        assert wdip.image_size('Example.jpg') == (100, 100)
+    [params] = session.requests
+    assert params['prop'] == {'imageinfo', 'info'}
+    assert params['iiprop'] == {'extmetadata', 'url', 'size', 'mime'}
+    assert params['iiurlwidth'] == 8000
+
+
+def test_load_items_and_property_batched(wiki_session):
+    item_ids = ['Q%d' % i for i in range(1, 61)]
+    session = wiki_session(item_ids)
+    with wdip.app.test_request_context():
+        wdip.flask.g.interface_language_code = 'en'
+        items = wdip.load_items_and_property(item_ids, 'P18', include_depicteds=True)
+    assert [item['entity_id'] for item in items] == item_ids
+    assert items[0]['image_title'] == 'Q1.jpg'
+    assert items[0]['label'] == {'language': 'en', 'value': 'label of Q1'}
+    # 2 × claims, 2 × imageinfo, 2 × labels
+    assert len(session.requests) == 6
+
+
+def test_run_concurrently():
+    with wdip.app.test_request_context():
+        wdip.flask.g.interface_language_code = 'de'
+        results = wdip.run_concurrently(
+            lambda: 'first',
+            lambda: wdip.flask.g.interface_language_code,
+            lambda: wdip.flask.request.path,
+        )
+    assert results == ['first', 'de', '/']
+
+
+class JsonHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_GET(self):
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_pooled_requests_session_reuses_connections():
+    with http.server.ThreadingHTTPServer(('localhost', 0), JsonHandler) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host = 'http://localhost:%d' % server.server_address[1]
+        session = mwapi.Session(host=host, session=wdip.pooled_requests_session())
+        for _ in range(10):
+            session.get(action='query')
+        pools = session.session.get_adapter(host).poolmanager.pools
+        [pool] = [pools.get(key) for key in pools.keys()]
+        server.shutdown()
+    assert pool.num_requests == 10
+    assert pool.num_connections == 1
+
+
+def test_anonymous_session_reused():
+    assert wdip.anonymous_session('www.wikidata.org') is wdip.anonymous_session('www.wikidata.org')
+    assert wdip.anonymous_session('www.wikidata.org') is not wdip.anonymous_session('commons.wikimedia.org')
+
+
+class FakeEditSession:
+    """Fake authenticated mwapi.Session that hands out CSRF tokens and accepts only the latest one."""
+
+    def __init__(self):
+        self.tokens = 0
+        self.requests = []
+
+    def get(self, **params):
+        assert params['meta'] == 'tokens'
+        self.requests.append(params)
+        self.tokens += 1
+        return {'query': {'tokens': {'csrftoken': 'token%d+\\' % self.tokens}}}
+
+    def post(self, **params):
+        self.requests.append(params)
+        if params['token'] != 'token%d+\\' % self.tokens:
+            raise mwapi.errors.APIError('badtoken', 'Invalid CSRF token.', None)
+        return {'success': 1}
+
+
+def test_post_with_csrf_token(monkeypatch):
+    monkeypatch.setattr(wdip, '_csrf_tokens', wdip.cachetools.TTLCache(maxsize=10, ttl=60))
+    session = FakeEditSession()
+    with wdip.app.test_request_context():
+        wdip.flask.session['oauth_access_token'] = {'key': 'key', 'secret': 'secret'}
+        wdip.post_with_csrf_token(session, 'www.wikidata.org', action='wbsetqualifier')
+        wdip.post_with_csrf_token(session, 'www.wikidata.org', action='wbsetqualifier')
+        assert len(session.requests) == 3  # one token, two edits
+        session.tokens += 1  # session token changed on the wiki
+        wdip.post_with_csrf_token(session, 'www.wikidata.org', action='wbsetqualifier')
+        assert len(session.requests) == 6  # failed edit, new token, retried edit
+
+
+class FakeQualifierSession(FakeEditSession):
+    """Fake authenticated mwapi.Session that “sets” region qualifiers."""
+
+    def post(self, **params):
+        super().post(**params)
+        if params['claim'].endswith('$missing'):
+            raise mwapi.errors.APIError('no-such-qualifier', 'No such qualifier.', None)
+        value = json.loads(params['value'])
+        return {'claim': {'qualifiers': {'P2677': [{
+            'snaktype': 'value',
+            'datavalue': {'value': value},
+            'hash': 'hash of ' + value,
+        }]}}}
+
+
+def test_api_add_qualifiers(monkeypatch):
+    session = FakeQualifierSession()
+    monkeypatch.setattr(wdip, 'authenticated_session', lambda domain: session)
+    monkeypatch.setattr(wdip, '_csrf_tokens', wdip.cachetools.TTLCache(maxsize=10, ttl=60))
+    qualifiers = [
+        {'statement_id': 'Q1$a', 'iiif_region': 'pct:0,0,50,50'},
+        {'statement_id': 'Q2$b', 'iiif_region': 'pct:50.0,50,50,50', 'qualifier_hash': 'old'},
+        {'statement_id': 'Q1$missing', 'iiif_region': 'full', 'qualifier_hash': 'old'},
+    ]
+    with wdip.app.test_client() as client:
+        with client.session_transaction() as flask_session:
+            flask_session['_csrf_token'] = 'csrf'
+            flask_session['oauth_access_token'] = {'key': 'key', 'secret': 'secret'}
+        response = client.post('/api/v3/add_qualifiers/www.wikidata.org?uselang=en',
+                               data={'_csrf_token': 'csrf', 'qualifiers': json.dumps(qualifiers)},
+                               headers={'Referer': 'http://localhost/'})
+    assert response.get_json()['results'] == [
+        {'statement_id': 'Q1$a', 'qualifier_hash': 'hash of pct:0,0,50,50'},
+        {'statement_id': 'Q2$b', 'qualifier_hash': 'hash of pct:50,50,50,50'},
+        {'statement_id': 'Q1$missing', 'error': 'This region does not exist (anymore) – it may have been edited in the meantime. Please try reloading the page.'},
+    ]
+    assert session.tokens == 1
+
+
+@pytest.mark.parametrize('qualifiers', [
+    [
+        {'statement_id': 'Q1$a', 'iiif_region': 'pct:0,0,50,50'},
+        {'statement_id': 'Q1$b', 'iiif_region': 'pct:0,0,0,50'},
+    ],
+    [{'statement_id': ['Q1$a'], 'iiif_region': 'full'}],
+    [{'statement_id': 'Q1$a', 'iiif_region': {'x': 0}}],
+    [{'statement_id': 'Q1$a', 'iiif_region': 'full', 'qualifier_hash': 1}],
+    [{'statement_id': f'Q{n}$a', 'iiif_region': 'full'} for n in range(wdip.max_qualifiers_per_request + 1)],
+])
+def test_api_add_qualifiers_invalid(monkeypatch, qualifiers):
+    session = FakeQualifierSession()
+    monkeypatch.setattr(wdip, 'authenticated_session', lambda domain: session)
+    with wdip.app.test_client() as client:
+        with client.session_transaction() as flask_session:
+            flask_session['_csrf_token'] = 'csrf'
+        response = client.post('/api/v3/add_qualifiers/www.wikidata.org?uselang=en',
+                               data={'_csrf_token': 'csrf', 'qualifiers': json.dumps(qualifiers)},
+                               headers={'Referer': 'http://localhost/'})
+    assert response.status_code == 400
+    assert session.tokens == 0
+
+
+def test_api_add_qualifiers_time_limit(monkeypatch):
+    session = FakeQualifierSession()
+    monkeypatch.setattr(wdip, 'authenticated_session', lambda domain: session)
+    monkeypatch.setattr(wdip, '_csrf_tokens', wdip.cachetools.TTLCache(maxsize=10, ttl=60))
+    monkeypatch.setattr(wdip, 'add_qualifiers_time_limit', -1)
+    qualifiers = [{'statement_id': 'Q1$a', 'iiif_region': 'full'}]
+    with wdip.app.test_client() as client:
+        with client.session_transaction() as flask_session:
+            flask_session['_csrf_token'] = 'csrf'
+            flask_session['oauth_access_token'] = {'key': 'key', 'secret': 'secret'}
+        response = client.post('/api/v3/add_qualifiers/www.wikidata.org?uselang=en',
+                               data={'_csrf_token': 'csrf', 'qualifiers': json.dumps(qualifiers)},
+                               headers={'Referer': 'http://localhost/'})
+    [result] = response.get_json()['results']
+    assert result['statement_id'] == 'Q1$a'
+    assert result['retry'] is True
+    assert 'qualifier_hash' not in result
+
+
+def test_iiif_without_thumbnail(wiki_session, language_info):
+    wiki_session(['Q1'], depicteds=1, thumbnails=False)
+    with wdip.app.test_client() as client:
+        manifest = client.get('/iiif/Q1/P18/manifest.json?uselang=en').get_json()
+        [canvas] = manifest['sequences'][0]['canvases']
+        assert (canvas['width'], canvas['height']) == (100, 100)
+        assert 'thumbnail' not in canvas
+        assert client.get('/iiif/Q1/P18/list/annotations.json?uselang=en').status_code == 200
+        collection = client.get('/iiif/collection/P18/collection.json?items=Q1&page=1&uselang=en').get_json()
+        [manifest] = collection['manifests']
+        assert 'thumbnail' not in manifest
+
+
+def test_manifest_cached(wiki_session):
+    session = wiki_session(['Q1'])
+    with wdip.app.test_client() as client:
+        first = client.get('/iiif/Q1/P18/manifest.json?uselang=en')
+        assert len(session.requests) == 3  # entity, image info, labels
+        second = client.get('/iiif/Q1/P18/manifest.json?uselang=en')
+        assert len(session.requests) == 5  # entity and image info (for the revisions) again
+    assert first.get_json() == second.get_json()
+    assert first.get_json()['label'] == {'@language': 'en', '@value': 'label of Q1'}
+
+
+def test_manifest_not_modified(wiki_session):
+    session = wiki_session(['Q1'])
+    with wdip.app.test_client() as client:
+        response = client.get('/iiif/Q1/P18/manifest.json?uselang=en')
+        etag = response.headers['ETag']
+        assert response.headers['Cache-Control'] == 'public, max-age=300'
+        session.requests.clear()
+        response = client.get('/iiif/Q1/P18/manifest.json?uselang=en',
+                              headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        assert len(session.requests) == 2  # entity and image info, nothing else
+        response = client.get('/iiif/Q1/P18/manifest.json?uselang=de',
+                              headers={'If-None-Match': etag})
+        assert response.status_code == 200
+
+
+def test_generate_manifests(wiki_session, tmp_path):
+    item_ids = ['Q%d' % i for i in range(1, 121)]
+    wiki_session(item_ids)
+    checkpoint = tmp_path / 'checkpoint'
+    checkpoint.write_text('Q1\nQ2\n')
+    output = tmp_path / 'manifests.jsonl'
+    result = wdip.app.test_cli_runner().invoke(args=['generate-manifests',
+                                                     '--output-jsonl', str(output),
+                                                     '--checkpoint', str(checkpoint)],
+                                               input='\n'.join(item_ids) + '\n')
+    assert result.exit_code == 0, result.output
+    lines = [json.loads(line) for line in output.read_text().splitlines()]
+    assert sorted(line['item_id'] for line in lines) == sorted(item_ids[2:])
+    manifest = next(line['manifest'] for line in lines if line['item_id'] == 'Q3')
+    assert manifest['@id'] == 'https://wd-image-positions.toolforge.org/iiif/Q3/P18/manifest.json'
+    assert set(checkpoint.read_text().split()) == set(item_ids)
+
+
+def test_iiif_collection(wiki_session, language_info):
+    item_ids = ['Q%d' % i for i in range(1, 61)]
+    session = wiki_session(item_ids)
+    url = '/iiif/collection/P18/collection.json?uselang=en&items=' + ','.join(item_ids)
+    with wdip.app.test_client() as client:
+        collection = client.get(url).get_json()
+        assert collection['total'] == 60
+        assert collection['label'] == '60 items'
+        assert len(session.requests) == 0
+        first_page = client.get(collection['first'] + '&uselang=en').get_json()
+        assert len(session.requests) == 3  # entities, image info, labels
+        assert len(first_page['manifests']) == 50
+        assert first_page['manifests'][0]['@id'] == 'http://localhost/iiif/Q1/P18/manifest.json'
+        assert first_page['manifests'][0]['label'] == {'@language': 'en', '@value': 'label of Q1'}
+        second_page = client.get(first_page['next'] + '&uselang=en').get_json()
+        assert len(second_page['manifests']) == 10
+        assert second_page['startIndex'] == 50
+        assert 'next' not in second_page
+
+
+@pytest.mark.parametrize('depicteds', [0, 3, 120])
+def test_iiif_annotations(wiki_session, depicteds):
+    wiki_session(['Q1'], depicteds=depicteds)
+    with wdip.app.test_client() as client:
+        response = client.get('/iiif/Q1/P18/list/annotations.json?uselang=en')
+        annolist = json.loads(response.get_data())
+    # streamed responses have no Content-Length
+    assert ('Content-Length' not in response.headers) == (depicteds > wdip.annotations_streaming_threshold)
+    assert annolist['label'] == 'Annotations for label of Q1'
+    assert len(annolist['resources']) == depicteds
+    if depicteds:
+        assert annolist['resources'][-1]['resource']['chars'] == 'label of Q%d' % (1000 + depicteds - 1)
+        assert annolist['resources'][0]['on'] == 'http://localhost/iiif/Q1/P18/canvas/c0.json#xywh=10,20,50,50'
+
+
+def test_file_depicteds_regions(wiki_session):
+    wiki_session(['M1'], depicteds=3)
+    with wdip.app.test_client() as client:
+        response = client.get('/api/v1/depicteds_regions/file/M1.jpg?uselang=en')
+        assert [depicted['statement_id'] for depicted in response.get_json()['depicteds']] == ['M1$0', 'M1$1', 'M1$2']
+        assert response.get_json()['duplicates'] == [['M1$0', 'M1$1'], ['M1$0', 'M1$2'], ['M1$1', 'M1$2']]
+        assert response.headers['Access-Control-Allow-Origin'] == '*'
+        response = client.get('/api/v1/depicteds_regions/file/M1.jpg?uselang=en&point=20,30')
+        assert len(response.get_json()['depicteds']) == 3
+        response = client.get('/api/v1/depicteds_regions/file/M1.jpg?uselang=en&point=pct:5,5')
+        assert response.get_json()['depicteds'] == []
+        response = client.get('/api/v1/depicteds_regions/file/M1.jpg?uselang=en&region=pct:0,0,5,5')
+        assert response.get_json()['depicteds'] == []
+        response = client.get('/api/v1/depicteds_regions/file/M1.jpg?uselang=en&region=pct:0,0,0,5')
+        assert response.status_code == 400
+
+
+def test_server_timing_and_debug_footer(wiki_session, language_info):
+    wiki_session(['Q1'])
+    with wdip.app.test_client() as client:
+        response = client.get('/item/Q1?uselang=en')
+        assert response.status_code == 200
+        assert response.headers['Server-Timing'].startswith('total;dur=')
+        assert 'Request timing' not in response.get_data(as_text=True)
+        response = client.get('/item/Q1?uselang=en&timing')
+        assert 'Request timing' in response.get_data(as_text=True)
+        assert 'item.html;desc="x1"' in response.headers['Server-Timing']
+        response = client.get('/healthz/timing')
+        assert any(histogram['action'] == 'item.html' for histogram in response.get_json()['histograms'])
+
+
+def test_metrics(wiki_session, language_info):
+    wiki_session(['Q1'])
+    span = wdip.tracing.Span('api', 'www.wikidata.org', 'wbsetqualifier')
+    span.duration = 0.1
+    span.error = 'badtoken'
+    wdip.metrics.observe_span(span)
+    with wdip.app.test_client() as client:
+        client.get('/iiif/Q1/P18/manifest.json?uselang=en')
+        response = client.get('/metrics')
+    assert response.content_type.startswith('text/plain')
+    text = response.get_data(as_text=True)
+    assert 'wdip_request_duration_seconds_count{endpoint="iiif_manifest_with_property",method="GET"}' in text
+    assert 'wdip_upstream_api_errors_total{code="badtoken",domain="www.wikidata.org"} 1.0' in text
+    assert 'wdip_cache_misses_total{cache="manifests"}' in text
+    assert 'wdip_cache_size{cache="manifests"} 1.0' in text
+
+
+def test_region_index(monkeypatch, tmp_path, fake_backend, upstream_recorder):
+    dump = tmp_path / 'dump.json'
+    dump.write_text('[\n' + ',\n'.join(json.dumps(fake_backend.entity(entity_id, ['en']))
+                                       for entity_id in ['Q1', 'Q2', 'Q3', 'Q1000', 'M1']) + '\n]\n')
+    index = str(tmp_path / 'regions.sqlite')
+    runner = wdip.app.test_cli_runner()
+    result = runner.invoke(args=['region-index', 'build', '--index', index, str(dump)])
+    assert result.exit_code == 0, result.output
+    monkeypatch.setattr(wdip, 'region_store', region_index.RegionStore(index, readonly=True))
+
+    with wdip.app.test_client() as client, upstream_recorder() as recorder:
+        response = client.get('/iiif_region/pct:10,0,10,10?uselang=en')
+    assert response.status_code == 200
+    assert ('query.wikidata.org', 'sparql') not in recorder.actions
+    html = response.get_data(as_text=True)
+    assert 'Q3' in html
+    assert 'Q4' not in html
+
+    events = [
+        {'wiki': 'wikidatawiki', 'namespace': 0, 'title': 'Q4', 'type': 'new', 'timestamp': 100},
+        {'wiki': 'commonswiki', 'namespace': 6, 'title': 'File:Q2.jpg', 'type': 'edit', 'timestamp': 200},
+    ]
+    result = runner.invoke(args=['region-index', 'update', '--index', index],
+                           input=''.join(json.dumps(event) + '\n' for event in events))
+    assert result.exit_code == 0, result.output
+    assert wdip.region_store.entities_with_region('pct:10,0,10,10', 'Q', limit=10) == ['Q1', 'Q2', 'Q3', 'Q4']
+    assert wdip.region_store.entities_with_region('pct:10,0,10,10', 'M', limit=10) == ['M1', 'M2']
+    assert wdip.region_store.get_meta('last_change') == '200'
+    # regions that are not in the index are still looked up with the query service
+    assert wdip.items_with_iiif_region('full', limit=10)[0] == ['Q%d' % i for i in range(1, 11)]
+
+
+def depicted_statement(property_id, iiif_region=None):
+    statement = {
+        'mainsnak': {'snaktype': 'value', 'property': property_id,
+                     'datavalue': {'value': {'entity-type': 'item', 'id': 'Q5'}, 'type': 'wikibase-entityid'}},
+        'type': 'statement',
+        'id': 'Q1$' + str(iiif_region),
+        'rank': 'normal',
+    }
+    if iiif_region is not None:
+        statement['qualifiers'] = {'P2677': [{'snaktype': 'value', 'property': 'P2677', 'hash': 'abc',
+                                              'datavalue': {'value': iiif_region, 'type': 'string'}}]}
+    return statement
+
+
+dump_entities = [
+    {'type': 'item', 'id': 'Q1', 'claims': {
+        'P18': [{'mainsnak': {'snaktype': 'value', 'property': 'P18', 'datavalue': {'value': 'A.jpg', 'type': 'string'}},
+                 'type': 'statement', 'id': 'Q1$image', 'rank': 'normal'}],
+        'P180': [depicted_statement('P180', 'full'), depicted_statement('P180', 'pct:0,0,50,50'), depicted_statement('P180')],
+    }},
+    {'type': 'item', 'id': 'Q2', 'claims': {}},
+    {'type': 'mediainfo', 'id': 'M1', 'title': 'File:A.jpg', 'statements': {
+        'P180': [depicted_statement('P180', '10,10,100,100'), depicted_statement('P180', 'pct:0,0,3,3')],
+        'P9664': [depicted_statement('P9664', 'invalid'), depicted_statement('P9664')],
+    }},
+    {'type': 'mediainfo', 'id': 'M2', 'title': 'File:B.jpg', 'statements': []},  # T222159
+]
+
+
+def test_region_statistics():
+    summary = wdip.summarize_region_statistics(wdip.region_statistics(dump_entities))
+    assert summary == {
+        'entities': 4,
+        'entities_with_image': 1,
+        'entities_with_depicteds': 2,
+        'entities_with_regions': 2,
+        'properties': {
+            'P180': {'statements': 5, 'with_region': 4, 'share_with_region': 0.8},
+            'P9664': {'statements': 2, 'with_region': 1, 'share_with_region': 0.5},
+        },
+        'region_kinds': {'full': 1, 'pct': 2, 'pixel': 1, 'invalid': 1},
+        'region_area_percent': {'<=1': 1, '<=5': 0, '<=10': 0, '<=25': 1, '<=50': 0, '<=100': 1},
+    }
+
+
+def test_dump_stats(tmp_path):
+    wikidata_dump = tmp_path / 'wikidata.json.gz'
+    with gzip.open(wikidata_dump, 'wt') as f:
+        f.write('[\n' + ',\n'.join(json.dumps(entity) for entity in dump_entities[:2]) + '\n]\n')
+    commons_dump = tmp_path / 'commons.json.bz2'
+    with bz2.open(commons_dump, 'wt') as f:
+        f.write('[\n' + ',\n'.join(json.dumps(entity) for entity in dump_entities[2:]) + '\n]\n')
+    output = tmp_path / 'stats.json'
+    result = wdip.app.test_cli_runner().invoke(args=['dump-stats', '--processes', '2', '--output', str(output),
+                                                     str(wikidata_dump), str(commons_dump)])
+    assert result.exit_code == 0, result.output
+    assert json.loads(output.read_text()) == wdip.summarize_region_statistics(wdip.region_statistics(dump_entities))
+
+
+def test_queue(monkeypatch, fake_backend):
+    monkeypatch.setattr(wdip, 'queue_prefetch_size', 3)
+    monkeypatch.setattr(wdip, '_queues_cache', caches.MemoryCache(maxsize=10, ttl=60))
+    monkeypatch.setattr(wdip, '_prefetched_files', wdip.cachetools.LRUCache(maxsize=10))
+    with wdip.app.test_client() as client:
+        response = client.post('/?uselang=en', data={'queue_source': 'category', 'queue_input': 'Paintings'})
+        assert response.status_code == 302
+        queue_url = response.headers['Location']
+        assert queue_url.endswith('/1')
+        queue_id = queue_url.split('/')[-2]
+
+        response = client.get(queue_url + '?uselang=en')
+        assert response.status_code == 200
+        html = response.get_data(as_text=True)
+        assert 'File 1 of 10' in html
+        assert 'data-entity-id="M1"' in html
+        prefetched = wdip._prefetched_files[queue_id]
+        assert sorted(title for language, title in prefetched) == ['Q2.jpg', 'Q3.jpg', 'Q4.jpg']
+        prefetched['en', 'Q2.jpg'].result()  # wait for the prefetching
+
+        response = client.get(f'/queue/{queue_id}/2?uselang=en')
+        assert response.status_code == 200
+        html = response.get_data(as_text=True)
+        assert 'data-entity-id="M2"' in html
+        assert 'label of Q1001 (en)' in html
+        # the file was prefetched, so the request itself sent no API requests
+        assert 'commons.wikimedia.org' not in response.headers['Server-Timing']
+        assert ('en', 'Q2.jpg') not in prefetched  # loaded again if the user comes back
+        assert ('en', 'Q5.jpg') in prefetched
+
+        response = client.post('/?uselang=en', data={'queue_source': 'ids', 'queue_input': 'M3, M1 M3'})
+        new_queue_id = response.headers['Location'].split('/')[-2]
+        assert queue_id not in wdip._prefetched_files
+        assert wdip._queues_cache.get(new_queue_id)['titles'] == ['Q3.jpg', 'Q1.jpg']
+        response = client.get(f'/queue/{new_queue_id}/2?uselang=en')
+        assert 'File 2 of 2' in response.get_data(as_text=True)
+
+        assert client.get(f'/queue/{new_queue_id}/3?uselang=en').status_code == 404
+        assert client.get('/queue/unknown/1?uselang=en').status_code == 404
+        response = client.post('/?uselang=en', data={'queue_source': 'ids', 'queue_input': 'Q1'})
+        assert response.status_code == 404
+
+
+def test_queue_prefetch_not_started(monkeypatch, fake_backend):
+    monkeypatch.setattr(wdip, 'queue_prefetch_size', 2)
+    monkeypatch.setattr(wdip, '_queues_cache', caches.MemoryCache(maxsize=10, ttl=60))
+    monkeypatch.setattr(wdip, '_prefetched_files', wdip.cachetools.LRUCache(maxsize=10))
+    prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(wdip, 'prefetch_executor', prefetch_executor)
+    busy = threading.Event()
+    prefetch_executor.submit(busy.wait, 10)  # keeps the prefetching from starting
+    try:
+        with wdip.app.test_client() as client:
+            response = client.post('/?uselang=en', data={'queue_source': 'category', 'queue_input': 'Paintings'})
+            queue_url = response.headers['Location']
+            queue_id = queue_url.split('/')[-2]
+            client.get(queue_url + '?uselang=en')
+            prefetched = wdip._prefetched_files[queue_id]
+            queued = prefetched['en', 'Q2.jpg']
+
+            # the queued prefetch is cancelled and the file loaded directly, without waiting
+            response = client.get(f'/queue/{queue_id}/2?uselang=en')
+            assert response.status_code == 200
+            assert 'data-entity-id="M2"' in response.get_data(as_text=True)
+            assert queued.cancelled()
+            # the other file of the cancelled prefetch is prefetched again
+            assert not prefetched['en', 'Q3.jpg'].cancelled()
+    finally:
+        busy.set()
+        prefetch_executor.shutdown()
+
+
+def test_iiif_collection_region_label(fake_backend):
+    with wdip.app.test_client() as client:
+        collection = client.get('/iiif/collection/region/pct:10,20,50,50/P18/collection.json?uselang=en').get_json()
+    assert collection['label'] == 'Items with region pct:10,20,50,50'
+
+
+def test_server_timing_format_value(fake_backend):
+    with wdip.app.test_client() as client:
+        response = client.get('/iiif/Q1/P18/manifest.json?uselang=en')
+    assert response.status_code == 200
+    assert 'wbformatvalue' in response.headers['Server-Timing']
@@ -0,0 +1,132 @@
+import pytest
+import socketserver
+import threading
+import time
+
+import caches
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Minimal stand-in for a Redis server, supporting MGET and SET (ignoring expiry)."""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                command.append(self.rfile.read(length + 2)[:-2])
+            name = command[0].upper()
+            if name == b'SET':
+                self.server.data[command[1]] = command[2]
+                self.wfile.write(b'+OK\r\n')
+            elif name == b'MGET':
+                reply = b'*%d\r\n' % (len(command) - 1)
+                for key in command[1:]:
+                    value = self.server.data.get(key)
+                    if value is None:
+                        reply += b'$-1\r\n'
+                    else:
+                        reply += b'$%d\r\n%s\r\n' % (len(value), value)
+                self.wfile.write(reply)
+            else:
+                self.wfile.write(b'-ERR unknown command\r\n')
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    block_on_close = False
+
+
+@pytest.fixture
+def redis_url():
+    with FakeRedisServer(('localhost', 0), FakeRedisHandler) as server:
+        server.data = {}
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield 'redis://localhost:%d/0' % server.server_address[1]
+        server.shutdown()
+
+
+@pytest.fixture(params=['memory', 'file', 'redis'])
+def cache(request, tmp_path):
+    if request.param == 'redis':
+        config = {'BACKEND': 'redis', 'URL': request.getfixturevalue('redis_url')}
+    else:
+        config = {'BACKEND': request.param, 'DIRECTORY': str(tmp_path)}
+    return caches.make_cache(config, 'test', maxsize=10, ttl=60)
+
+
+def test_cache_get_set(cache):
+    assert cache.get('a') is None
+    cache.set_many({'a': {'value': 1}, 'b': None})
+    assert cache.get_many(['a', 'b', 'c']) == {'a': {'value': 1}, 'b': None}
+    assert cache.get('c', 'default') == 'default'
+
+
+def test_cache_hits_and_misses(cache):
+    cache.set('a', 1)
+    cache.get_many(['a', 'b'])
+    cache.get('a')
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_file_cache_expires(tmp_path):
+    cache = caches.FileCache('test', maxsize=10, ttl=0, directory=str(tmp_path))
+    cache.set('a', 1)
+    time.sleep(0.01)
+    assert cache.get_many(['a']) == {}
+    assert list((tmp_path / 'test').iterdir()) == []
+
+
+def test_redis_cache_unavailable(redis_url):
+    cache = caches.RedisCache('test', ttl=60, url='redis://localhost:1/0')
+    cache.set('a', 1)
+    assert cache.get_many(['a']) == {}
+    # after the failure, the cache should not try to connect again for a while
+    cache._address = caches.RedisCache('test', ttl=60, url=redis_url)._address
+    cache.set('a', 1)
+    assert cache.get_many(['a']) == {}
+
+
+def test_redis_cache_reconnects(redis_url, monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(caches.time, 'monotonic', lambda: now)
+    cache = caches.RedisCache('test', ttl=60, url='redis://localhost:1/0')
+    cache.set('a', 1)
+    unavailable_until = cache._unavailable_until
+    assert unavailable_until == now + cache.retry_interval
+    # calls during the retry interval do not extend it
+    now += cache.retry_interval / 2
+    cache.set('a', 1)
+    assert cache.get_many(['a']) == {}
+    assert cache._unavailable_until == unavailable_until
+    # once it has passed, the server is contacted again
+    cache._address = caches.RedisCache('test', ttl=60, url=redis_url)._address
+    now += cache.retry_interval
+    cache.set('a', 1)
+    assert cache.get_many(['a']) == {'a': 1}
+
+
+def test_redis_cache_namespace(redis_url):
+    caches.RedisCache('one', ttl=60, url=redis_url).set('a', 1)
+    assert caches.RedisCache('two', ttl=60, url=redis_url).get('a') is None
+    assert caches.RedisCache('one', ttl=60, url=redis_url).get('a') == 1
+
+
+def test_file_cache_maxsize(tmp_path):
+    cache = caches.FileCache('test', maxsize=2, ttl=60, directory=str(tmp_path))
+    cache.set_many({'a': 1, 'b': 2, 'c': 3})
+    cache.prune()
+    assert len(list((tmp_path / 'test').iterdir())) == 2
+    assert (tmp_path / 'test').stat().st_mode & 0o777 == 0o700
+
+
+def test_file_cache_corrupt_entry(tmp_path):
+    cache = caches.FileCache('test', maxsize=10, ttl=60, directory=str(tmp_path))
+    cache.set('a', 1)
+    [path] = (tmp_path / 'test').iterdir()
+    path.write_text('[1, 2')
+    assert cache.get_many(['a']) == {}
@@ -0,0 +1,91 @@
+"""Budgets for the upstream API calls of the main routes.
+
+These tests fail if a change adds calls to a route,
+in particular another serial round trip (which directly adds latency).
+If a new call is really necessary, adjust the budget in the same change,
+so that the increase is visible in review.
+"""
+
+import pytest
+
+import app as wdip
+
+
+def get(client, path):
+    response = client.get(path, query_string={'uselang': 'en'})
+    response.get_data()  # consume streamed responses
+    assert response.status_code == 200
+    return response
+
+
+@pytest.fixture
+def client(fake_backend):
+    client = wdip.app.test_client()
+    # the depicted property labels are cached for a long time and needed by every page;
+    # load them before the budgeted requests
+    with wdip.app.test_request_context():
+        wdip.depicted_properties_labels()
+    return client
+
+
+@pytest.mark.parametrize('path, max_round_trips, max_calls, warm_calls', [
+    # item, then image info and depicted labels in parallel
+    ('/item/Q1', 2, 3, 1),
+    # image info and MediaInfo (by title) in parallel, then depicted labels
+    ('/file/Q1.jpg', 2, 3, 1),
+    # the same, but the image info is never taken from the cache (for the revision ID)
+    ('/api/v1/depicteds_html/file/Q1.jpg', 2, 3, 2),
+    # item, then image revision, then image info, labels and metadata (one call per value) in parallel
+    ('/iiif/Q1/P18/manifest.json', 3, 8, 2),
+    # item, then image revision, then item label, then depicted labels (50 at a time)
+    ('/iiif/Q1/P18/list/annotations.json', 4, 4, 2),
+    # SPARQL (cached when warm), then items, then image info and labels in parallel
+    ('/iiif_region/pct:0,0,10,10', 3, 4, 1),
+])
+def test_call_budget(client, upstream_recorder, path, max_round_trips, max_calls, warm_calls):
+    with upstream_recorder() as cold:
+        get(client, path)
+    assert cold.round_trips <= max_round_trips, cold.actions
+    assert len(cold.calls) <= max_calls, cold.actions
+    with upstream_recorder() as warm:
+        get(client, path)
+    assert len(warm.calls) == warm_calls, warm.actions
+
+
+def test_item_page_parallel_calls(client, upstream_recorder):
+    with upstream_recorder() as recorder:
+        get(client, '/item/Q1')
+    assert recorder.actions == [
+        ('commons.wikimedia.org', 'query'),
+        ('www.wikidata.org', 'wbgetentities'),
+        ('www.wikidata.org', 'wbgetentities'),
+    ]
+    assert recorder.round_trips == 2
+
+
+def test_file_page_parallel_calls(client, upstream_recorder):
+    with upstream_recorder() as recorder:
+        get(client, '/file/Q1.jpg')
+    assert recorder.actions == [
+        ('commons.wikimedia.org', 'query'),
+        ('commons.wikimedia.org', 'wbgetentities'),
+        ('www.wikidata.org', 'wbgetentities'),
+    ]
+    query, mediainfo = sorted((span for span in recorder.calls if span.domain == 'commons.wikimedia.org'),
+                              key=lambda span: span.start)
+    assert mediainfo.start < query.start + query.duration  # sent in parallel
+
+
+def test_depicteds_html_not_modified(client, upstream_recorder, monkeypatch):
+    etag = get(client, '/api/v1/depicteds_html/file/Q1.jpg').headers['ETag']
+    # labels would have to be loaded again, but are not needed for a 304 response
+    monkeypatch.setattr(wdip, '_labels_cache', wdip.caches.MemoryCache(maxsize=100, ttl=60))
+    with upstream_recorder() as recorder:
+        response = client.get('/api/v1/depicteds_html/file/Q1.jpg', query_string={'uselang': 'en'},
+                              headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert recorder.actions == [
+        ('commons.wikimedia.org', 'query'),
+        ('commons.wikimedia.org', 'wbgetentities'),
+    ]
+    assert recorder.round_trips == 1
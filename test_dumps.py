@@ -0,0 +1,38 @@
+import bz2
+import gzip
+import json
+import pytest
+
+import dumps
+
+
+@pytest.mark.parametrize('suffix, open_file', [
+    ('.json', open),
+    ('.json.gz', gzip.open),
+    ('.json.bz2', bz2.open),
+])
+def test_iter_entities(tmp_path, suffix, open_file):
+    path = str(tmp_path / ('dump' + suffix))
+    with open_file(path, 'wt') as f:
+        f.write('[\n{"id": "Q1", "claims": {}},\n{"id": "Q2", "claims": []}\n]\n')
+    with dumps.open_dump(path) as f:
+        assert [entity['id'] for entity in dumps.iter_entities(f)] == ['Q1', 'Q2']
+
+
+def test_parse_line():
+    assert dumps.parse_line('[\n') is None
+    assert dumps.parse_line(']') is None
+    assert dumps.parse_line('{"id": "M1", "statements": []},\n') == json.loads('{"id": "M1", "statements": []}')
+
+
+def entity_ids(entities):
+    return [entity['id'] for entity in entities]
+
+
+def test_process_dump(tmp_path):
+    path = str(tmp_path / 'dump.json.gz')
+    with gzip.open(path, 'wt') as f:
+        f.write('[\n' + ',\n'.join(json.dumps({'id': 'Q%d' % i, 'claims': {}}) for i in range(1, 101)) + '\n]\n')
+    chunks = list(dumps.process_dump(path, entity_ids, processes=2, chunk_size=7))
+    assert [entity_id for chunk in chunks for entity_id in chunk] == ['Q%d' % i for i in range(1, 101)]
+    assert len(chunks) == 15  # 102 lines including the brackets
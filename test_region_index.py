@@ -0,0 +1,85 @@
+import pytest
+
+import region_index
+
+
+def depicted(statement_id, item_id, iiif_region=None, property_id='P180'):
+    depicted = {'snaktype': 'value', 'statement_id': statement_id, 'property_id': property_id, 'item_id': item_id}
+    if iiif_region is not None:
+        depicted['iiif_region'] = iiif_region
+        depicted['qualifier_hash'] = 'abc'
+    return depicted
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = region_index.RegionStore(str(tmp_path / 'regions.sqlite'))
+    yield store
+    store.close()
+
+
+def test_replace_entities(store):
+    indexed = store.replace_entities([
+        ('Q2', 'Q2', [depicted('Q2$1', 'Q10', 'pct:0,0,50,50'), depicted('Q2$2', 'Q11', 'pct:0,0,50,50')]),
+        ('Q1', 'Q1', [depicted('Q1$1', 'Q10', 'pct:0,0,50,50'), depicted('Q1$2', 'Q11')]),
+        ('Q3', 'Q3', [depicted('Q3$1', 'Q10')]),
+        ('M1', 'File:A.jpg', [depicted('M1$1', 'Q10', 'pct:0,0,50,50', property_id='P9664')]),
+    ], batch_size=3)
+    assert indexed == 3
+    assert store.counts() == {'entities': 3, 'statements': 4}
+    store.set_meta('built', 1)
+    assert store.entities_with_region('pct:0,0,50,50', 'Q', limit=10) == ['Q1', 'Q2']
+    assert store.entities_with_region('pct:0,0,50,50', 'Q', limit=1, offset=1) == ['Q2']
+    assert store.entities_with_region('pct:0,0,50,50', 'M', limit=None) == ['M1']
+    assert store.entities_with_region('full', 'Q', limit=10) == []
+
+    # the region was removed from Q2, Q3 got one
+    store.replace_entities([
+        ('Q2', 'Q2', [depicted('Q2$1', 'Q10'), depicted('Q2$2', 'Q11')]),
+        ('Q3', 'Q3', [depicted('Q3$1', 'Q10', 'pct:0,0,50,50')]),
+    ])
+    assert store.entities_with_region('pct:0,0,50,50', 'Q', limit=10) == ['Q1', 'Q3']
+    assert store.counts() == {'entities': 3, 'statements': 3}
+
+
+def test_delete_entities(store):
+    store.replace_entities([
+        ('Q1', 'Q1', [depicted('Q1$1', 'Q10', 'full')]),
+        ('M1', 'File:A.jpg', [depicted('M1$1', 'Q10', 'full')]),
+        ('M2', 'File:B.jpg', [depicted('M2$1', 'Q10', 'full')]),
+    ])
+    store.delete_entities(entity_ids=['Q1'], titles=['File:B.jpg', 'File:Unknown.jpg'])
+    assert store.counts() == {'entities': 1, 'statements': 1}
+
+
+def test_readonly_store_not_built(store, tmp_path):
+    missing = region_index.RegionStore(str(tmp_path / 'missing.sqlite'), readonly=True)
+    assert missing.entities_with_region('full', 'Q', limit=10) is None
+    assert not (tmp_path / 'missing.sqlite').exists()
+
+    store.replace_entities([('Q1', 'Q1', [depicted('Q1$1', 'Q10', 'full')])])
+    readonly = region_index.RegionStore(store.path, readonly=True)
+    assert readonly.entities_with_region('full', 'Q', limit=10) is None
+    store.set_meta('built', 1)
+    assert readonly.entities_with_region('full', 'Q', limit=10) == ['Q1']
+    readonly.close()
+
+
+def test_changed_pages():
+    events = [
+        {'wiki': 'wikidatawiki', 'namespace': 0, 'title': 'Q1', 'type': 'edit', 'timestamp': 100},
+        {'wiki': 'wikidatawiki', 'namespace': 0, 'title': 'Q2', 'type': 'edit', 'timestamp': 200},
+        {'wiki': 'wikidatawiki', 'namespace': 120, 'title': 'Property:P180', 'type': 'edit', 'timestamp': 210},
+        {'wiki': 'commonswiki', 'namespace': 6, 'title': 'File:A.jpg', 'type': 'log', 'log_type': 'delete', 'timestamp': 220},
+        {'wiki': 'commonswiki', 'namespace': 6, 'title': 'File:B.jpg', 'type': 'log', 'log_type': 'move',
+         'log_params': {'target': 'File:C.jpg', 'noredir': '0'}, 'timestamp': 230},
+        {'wiki': 'commonswiki', 'namespace': 14, 'title': 'Category:X', 'type': 'edit', 'timestamp': 240},
+        {'wiki': 'enwiki', 'namespace': 0, 'title': 'Q3', 'type': 'edit', 'timestamp': 300},
+    ]
+    pages, latest = region_index.changed_pages(events, since=150)
+    assert pages == {
+        'www.wikidata.org': {'Q2'},
+        'commons.wikimedia.org': {'File:A.jpg', 'File:B.jpg', 'File:C.jpg'},
+    }
+    assert latest == 240
+    assert region_index.changed_pages([], since=150) == ({'www.wikidata.org': set(), 'commons.wikimedia.org': set()}, 150)
@@ -0,0 +1,155 @@
+import pytest
+import random
+
+from regions import Region, RegionIndex, depicted_regions, normalize, parse_point, regions_to_pixels
+
+
+@pytest.mark.parametrize('string, kind, values', [
+    ('full', 'full', (0, 0, 100, 100)),
+    ('pct:10,20,30,40', 'pct', (10, 20, 30, 40)),
+    ('pct:27.2,30,13.1,21.6', 'pct', (27.2, 30, 13.1, 21.6)),
+    ('10,20,30,40', 'pixel', (10, 20, 30, 40)),
+])
+def test_parse(string, kind, values):
+    region = Region.parse(string)
+    assert region.kind == kind
+    assert (region.x, region.y, region.w, region.h) == values
+
+
+@pytest.mark.parametrize('string', [
+    '',
+    'pct:',
+    'pct:10,20,30',
+    'pct:10,20,30,40,50',
+    'pct:-10,20,30,40',
+    'pct:10,20,0,40',
+    '10,20,30.5,40',
+    '10,20,30,0',
+    'square',
+    'pct:a,b,c,d',
+])
+def test_parse_invalid(string):
+    with pytest.raises(ValueError):
+        Region.parse(string)
+
+
+@pytest.mark.parametrize('string, expected', [
+    ('full', 'full'),
+    ('pct:10.0,20.50,30,40', 'pct:10,20.5,30,40'),
+    ('pct:.5,0,100,100', 'pct:0.5,0,100,100'),
+    ('010,20,30,40', '10,20,30,40'),
+])
+def test_normalize(string, expected):
+    assert normalize(string) == expected
+
+
+def test_region_immutable_and_hashable():
+    region = Region.parse('pct:10,20,30,40')
+    with pytest.raises(AttributeError):
+        region.x = 0
+    assert region == Region.parse('pct:10.0,20,30,40')
+    assert len({region, Region.parse('pct:10,20,30,40')}) == 1
+
+
+def test_pixel_pct_conversion():
+    region = Region.parse('100,50,200,100')
+    pct = region.to_pct(1000, 500)
+    assert str(pct) == 'pct:10,10,20,20'
+    assert pct.to_pixels(1000, 500) == region
+    assert str(Region.parse('full').to_pixels(640, 480)) == '0,0,640,480'
+
+
+@pytest.mark.parametrize('string, expected', [
+    ('full', 'left: 0px; top: 0px; width: 100%; height: 100%;'),
+    ('pct:10,20,50,40', 'left: 10%; top: 20%; width: 50%; height: 40%; z-index: 500;'),
+    ('10,20,1000,100', 'left: 10px; top: 20px; width: 1000px; height: 100px; z-index: 10000;'),
+])
+def test_style(string, expected):
+    assert Region.parse(string).style() == expected
+
+
+def test_depicted_regions():
+    depicteds = [
+        {'iiif_region': 'pct:10,20,30,40'},
+        {},
+        {'iiif_region': 'invalid'},
+    ]
+    with pytest.raises(ValueError):
+        depicted_regions(depicteds)
+    assert depicted_regions(depicteds, skip_invalid=True) == [Region.parse('pct:10,20,30,40'), None, None]
+
+
+def test_regions_to_pixels():
+    regions = [Region.parse('pct:10,20,50,50'), None, Region.parse('200,100,400,200'), Region.parse('full')]
+    assert [str(region) if region else None for region in regions_to_pixels(regions, (2000, 1000), (1000, 500))] == [
+        '100,100,500,250',
+        None,
+        '100,50,200,100',
+        '0,0,1000,500',
+    ]
+
+
+def random_regions(count, seed):
+    rng = random.Random(seed)
+    regions = []
+    for _ in range(count):
+        x, y = rng.uniform(0, 90), rng.uniform(0, 90)
+        regions.append(Region('pct', x, y, rng.uniform(0.1, 100 - x), rng.uniform(0.1, 100 - y)))
+    return regions
+
+
+@pytest.mark.parametrize('count', [0, 1, 15, 16, 17, 300])
+def test_region_index_matches_scan(count):
+    regions = random_regions(count, seed=count)
+    index = RegionIndex(regions, list(range(count)), (1000, 1000))
+    assert len(index) == count
+    rng = random.Random(-count)
+    for _ in range(20):
+        x, y = rng.uniform(0, 100), rng.uniform(0, 100)
+        expected = {i for i, region in enumerate(regions)
+                    if region.x <= x <= region.x + region.w and region.y <= y <= region.y + region.h}
+        assert set(index.containing(x, y)) == expected
+        query = random_regions(1, seed=rng.random())[0]
+        expected = {i for i, region in enumerate(regions)
+                    if region.x < query.x + query.w and query.x < region.x + region.w and
+                    region.y < query.y + query.h and query.y < region.y + region.h}
+        assert set(index.overlapping(query, (1000, 1000))) == expected
+
+
+def test_region_index_sorted_by_area():
+    regions = [Region.parse('pct:0,0,100,100'), Region.parse('pct:10,10,10,10'), Region.parse('pct:5,5,50,50')]
+    index = RegionIndex(regions, ['large', 'small', 'medium'], (1000, 1000))
+    assert index.containing(15, 15) == ['small', 'medium', 'large']
+
+
+def test_region_index_pixel_regions_and_none():
+    regions = [Region.parse('100,100,200,200'), None, Region.parse('pct:10,10,20,20')]
+    index = RegionIndex(regions, ['pixel', 'none', 'pct'], (1000, 1000))
+    assert index.containing(15, 15) == ['pixel', 'pct']
+    assert index.overlapping(Region.parse('0,0,50,50'), (1000, 1000)) == []
+
+
+def test_region_index_duplicates():
+    regions = [
+        Region.parse('pct:10,10,20,20'),
+        Region.parse('pct:50,50,10,10'),
+        Region.parse('pct:10.2,9.9,20,20.3'),
+        Region.parse('100,100,200,200'),
+        Region.parse('pct:10,10,25,20'),
+    ]
+    index = RegionIndex(regions, ['a', 'b', 'c', 'd', 'e'], (1000, 1000))
+    assert index.duplicates() == [('a', 'c'), ('a', 'd'), ('c', 'd')]
+
+
+@pytest.mark.parametrize('string, expected', [
+    ('pct:12.5,50', (12.5, 50)),
+    ('100,250', (10, 50)),
+])
+def test_parse_point(string, expected):
+    assert parse_point(string, (1000, 500)) == expected
+
+
+@pytest.mark.parametrize('string', ['', 'pct:1', '1,2,3', 'a,b', '-1,2'])
+def test_parse_point_invalid(string):
+    with pytest.raises(ValueError):
+        parse_point(string, (1000, 500))
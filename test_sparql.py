@@ -0,0 +1,96 @@
+import http.server
+import pytest
+import requests
+import threading
+import time
+
+import caches
+import sparql
+
+
+class SparqlHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/tab-separated-values')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        lines = ['?item\t?label\n'] + ['<http://www.wikidata.org/entity/Q%d>\t"label\\t%d"@en\n' % (i, i) for i in range(1, 4)]
+        for line in lines:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line.encode('utf8')))
+            self.wfile.flush()
+            time.sleep(self.server.delay)
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    with http.server.ThreadingHTTPServer(('localhost', 0), SparqlHandler) as server:
+        server.daemon_threads = True
+        server.requests = []
+        server.delay = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        yield server
+        server.shutdown()
+
+
+def endpoint(server, timeout=10):
+    return sparql.SparqlEndpoint('http://localhost:%d/sparql' % server.server_address[1],
+                                 requests.Session(),
+                                 caches.MemoryCache(maxsize=10, ttl=60),
+                                 timeout=timeout)
+
+
+def test_select(server):
+    result = endpoint(server).select('SELECT ?item ?label WHERE { ... }')
+    assert not result.partial
+    assert result.rows == [{'item': 'http://www.wikidata.org/entity/Q%d' % i, 'label': 'label\t%d' % i} for i in range(1, 4)]
+
+
+def test_select_cached_by_normalized_query(server):
+    query_service = endpoint(server)
+    first = query_service.select('SELECT ?item\nWHERE { ?item ?p "a  b" }', limit=10, offset=20)
+    second = query_service.select('  SELECT ?item WHERE {\n  ?item  ?p "a  b"\n}  ', limit=10, offset=20)
+    assert first.rows == second.rows
+    assert len(server.requests) == 1
+    assert 'LIMIT+10+OFFSET+20' in server.requests[0]
+    query_service.select('SELECT ?item WHERE { ?item ?p "a b" }', limit=10, offset=20)
+    assert len(server.requests) == 2  # different literal
+
+
+def test_select_timeout_partial(server):
+    server.delay = 0.2
+    query_service = endpoint(server, timeout=0.3)
+    result = query_service.select('SELECT ?item ?label WHERE { ... }')
+    assert result.partial
+    assert 0 < len(result.rows) < 3
+    query_service.select('SELECT ?item ?label WHERE { ... }')
+    assert len(server.requests) == 2  # partial results are not cached
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('SELECT  ?item\n\tWHERE {}', 'SELECT ?item WHERE {}'),
+    ('SELECT ?item WHERE { ?item rdfs:label "two  spaces" }', 'SELECT ?item WHERE { ?item rdfs:label "two  spaces" }'),
+    ('SELECT ?item WHERE { ?item ?p "escaped \\"  quote" }', 'SELECT ?item WHERE { ?item ?p "escaped \\"  quote" }'),
+])
+def test_normalize_query(query, expected):
+    assert sparql.normalize_query(query) == expected
+
+
+@pytest.mark.parametrize('term, expected', [
+    ('<http://www.wikidata.org/entity/Q1>', 'http://www.wikidata.org/entity/Q1'),
+    ('"pct:0,0,50,50"', 'pct:0,0,50,50'),
+    ('"label"@en', 'label'),
+    ('"5"^^<http://www.w3.org/2001/XMLSchema#integer>', '5'),
+    ('"a\\"b\\\\c"', 'a"b\\c'),
+    ('42', '42'),
+    ('', ''),
+])
+def test_parse_term(term, expected):
+    assert sparql.parse_term(term) == expected
@@ -0,0 +1,78 @@
+import flask
+import http.server
+import json
+import mwapi
+import pytest
+import threading
+
+import tracing
+
+
+class ApiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if 'action=error' in self.path:
+            body = json.dumps({'error': {'code': 'badvalue', 'info': 'Bad value.'}}).encode('utf8')
+        else:
+            body = b'{"batchcomplete": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def api_host():
+    with http.server.ThreadingHTTPServer(('localhost', 0), ApiHandler) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        yield 'http://localhost:%d' % server.server_address[1]
+        server.shutdown()
+
+
+def test_traced_session(api_host):
+    app = flask.Flask(__name__)
+    session = tracing.TracedSession(api_host, user_agent='test')
+    with app.app_context():
+        session.get(action='query')
+        with pytest.raises(mwapi.errors.APIError):
+            session.get(action='error')
+        spans = tracing.request_spans()
+    assert [(span.kind, span.action, span.error) for span in spans] == [
+        ('api', 'query', None),
+        ('api', 'error', 'badvalue'),
+    ]
+    assert spans[0].domain == api_host[len('http://'):]
+    assert spans[0].size == len(b'{"batchcomplete": true}')
+    assert all(span.duration > 0 for span in spans)
+
+
+def test_span_outside_app_context_recorded_in_histogram():
+    with tracing.span('test', 'example.org', 'histogram') as span:
+        span.size = 1
+    [histogram] = [histogram for histogram in tracing.histograms()
+                   if (histogram['kind'], histogram['domain'], histogram['action']) == ('test', 'example.org', 'histogram')]
+    assert histogram['count'] >= 1
+    assert sum(histogram['buckets']) == histogram['count']
+
+
+def test_server_timing():
+    spans = []
+    for kind, domain, action, duration in [
+            ('api', 'www.wikidata.org', 'wbgetentities', 0.010),
+            ('api', 'www.wikidata.org', 'wbgetentities', 0.020),
+            ('sparql', 'query.wikidata.org', 'sparql', 0.1),
+            ('render', None, 'item.html', 0.005),
+    ]:
+        span = tracing.Span(kind, domain, action)
+        span.duration = duration
+        spans.append(span)
+    assert tracing.server_timing(spans) == ', '.join([
+        'wbgetentities;desc="www.wikidata.org x2";dur=30.0',
+        'sparql;desc="query.wikidata.org x1";dur=100.0',
+        'item.html;desc="x1";dur=5.0',
+    ])
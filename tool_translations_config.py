@@ -13,6 +13,9 @@ _variables = {
     'index-placeholder-file-title': ['example_name', 'example_id', 'example_url'],  # ditto
     'alert-not-logged-in': ['url'],
     'file-not-found-body': ['title'],
+    'queue-position': ['position', 'count', 'label'],
+    'iiif-collection-label-items': ['num'],
+    'iiif-collection-label-region': ['region'],
     'wrong-data-value-type-paragraph-1': ['expected_data_value_type', 'actual_data_value_type'],
 }
 
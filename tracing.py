@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""Timing of upstream API calls and template rendering.
+
+Every span (one API request, SPARQL query or template rendering)
+is recorded in flask.g for the current request, if there is one,
+and added to histograms aggregated over the lifetime of the process.
+"""
+
+import bisect
+import contextlib
+import flask
+import mwapi
+import threading
+import time
+
+
+# upper bounds of the histogram buckets, in milliseconds (the last bucket is unbounded)
+histogram_buckets = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+# functions called with every finished span (e.g. to export it as a metric)
+_listeners = []
+
+
+class Span:
+    """One timed operation, e.g. an API request."""
+
+    __slots__ = ('kind', 'domain', 'action', 'start', 'duration', 'size', 'error')
+
+    def __init__(self, kind, domain, action):
+        self.kind = kind  # 'api', 'sparql', 'index' (the local region index) or 'render'
+        self.domain = domain
+        self.action = action
+        self.start = time.perf_counter()
+        self.duration = None  # in seconds
+        self.size = None  # of the response, in bytes
+        self.error = None  # e.g. the API error code
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+        record(self)
+
+    def to_json(self):
+        return {
+            'kind': self.kind,
+            'domain': self.domain,
+            'action': self.action,
+            'duration_ms': round(self.duration * 1000, 3),
+            'size': self.size,
+            'error': self.error,
+        }
+
+
+@contextlib.contextmanager
+def span(kind, domain, action):
+    """Time the code in the with block as a span, which it can add the size and error to."""
+    current = Span(kind, domain, action)
+    try:
+        yield current
+    finally:
+        current.finish()
+
+
+def record(span):
+    if flask.has_app_context():
+        # flask.g is shared with the executor threads (see app.run_concurrently),
+        # and list.append is atomic, so no lock is needed here
+        flask.g.setdefault('trace_spans', []).append(span)
+    key = (span.kind, span.domain, span.action)
+    with _histograms_lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'count': 0, 'sum': 0.0, 'buckets': [0] * (len(histogram_buckets) + 1)}
+        histogram['count'] += 1
+        histogram['sum'] += span.duration
+        histogram['buckets'][bisect.bisect_left(histogram_buckets, span.duration * 1000)] += 1
+    for listener in _listeners:
+        listener(span)
+
+
+def add_listener(listener):
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+def request_spans():
+    """The spans recorded so far during the current request."""
+    return flask.g.get('trace_spans', [])
+
+
+def histograms():
+    """The aggregate histograms of all spans in this process, as JSON.
+
+    The bucket counts are not cumulative;
+    each one counts the spans up to the corresponding bound in histogram_buckets
+    (and longer than the previous bound), the last one all longer spans."""
+    with _histograms_lock:
+        return [{'kind': kind, 'domain': domain, 'action': action,
+                 'count': histogram['count'],
+                 'sum_ms': round(histogram['sum'] * 1000, 3),
+                 'buckets': list(histogram['buckets'])}
+                for (kind, domain, action), histogram in sorted(_histograms.items(), key=lambda item: tuple(map(str, item[0])))]
+
+
+def server_timing(spans):
+    """Format spans for a Server-Timing header, summed up per kind, domain and action."""
+    totals = {}
+    for span in spans:
+        key = (span.kind, span.domain, span.action)
+        count, duration = totals.get(key, (0, 0.0))
+        totals[key] = (count + 1, duration + span.duration)
+    metrics = []
+    for (kind, domain, action), (count, duration) in totals.items():
+        name = action or kind
+        description = f'{domain} x{count}' if domain else f'x{count}'
+        metrics.append('%s;desc="%s";dur=%.1f' % (name, description, duration * 1000))
+    return ', '.join(metrics)
+
+
+class TracedSession(mwapi.Session):
+    """mwapi.Session that records a span for every API request."""
+
+    def __init__(self, host, *args, **kwargs):
+        super().__init__(host, *args, **kwargs)
+        self._domain = host.split('://', 1)[-1]
+        self._local = threading.local()
+        self.session.hooks['response'].append(self._remember_response)
+
+    def _remember_response(self, response, *args, **kwargs):
+        self._local.response = response
+
+    def _request(self, method, params=None, files=None, auth=None):
+        self._local.response = None
+        with span('api', self._domain, (params or {}).get('action')) as current:
+            try:
+                return super()._request(method, params=params, files=files, auth=auth)
+            except mwapi.errors.APIError as error:
+                current.error = error.code
+                raise
+            finally:
+                response = self._local.response
+                if response is not None and response._content_consumed:
+                    current.size = len(response.content)